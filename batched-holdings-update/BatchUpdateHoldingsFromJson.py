@@ -26,39 +26,185 @@ except:
 print("In a notebook: ", is_notebook)
 
 # %%
+import re
+from collections.abc import Iterator
 from pathlib import Path
+from typing import BinaryIO
 
 import orjson
 
+# a whole string literal (escapes and all) or a single bracket
+# a lone " means the string runs past the end of the buffer
+_json_tokens = re.compile(rb'"(?:[^"\\]++|\\.)*+"|[\[\]{}]|"')
 
-def to_ndjson(json_f: Path):
-    ndjson_f = Path("./mod_proxy_urls.ndjson")
-    prev_line = None
-    first = True
-    with json_f.open("r") as j, ndjson_f.open("w") as ndj:
-        for jl in j.readlines():
-            if first:
-                # skipping the opening array [
-                first = False
+
+def iter_records(f: BinaryIO, read_size: int = 2**24) -> Iterator[bytes]:
+    # Yields the raw bytes of each object in a top level json array.
+    # Only the current record is ever kept between reads so memory stays
+    #   bounded by read_size + the largest record.
+    # Anything at the array level that isn't an object (nulls!) is skipped.
+    buf = b""
+    pos = 0
+    depth = 0
+    rec_start = None
+    # exports are usually one record per line so try handing the whole line
+    #   to orjson before walking it token by token
+    slow_until = -1
+    while block := f.read(read_size):
+        buf += block
+        nl = None
+        while m := _json_tokens.search(buf, pos):
+            t = m.group()
+            if t == b'"':
+                # incomplete string, wait for more bytes
+                pos = m.start()
+                break
+            pos = m.end()
+            if t[0] == ord('"'):
                 continue
-            if prev_line is not None and prev_line != "null,":
-                # skipping the closing array ] by having a lag of 1 line
-                # somehow there's also nulls in the list, idk?
-                ndj.write(prev_line)
-            # I manually checked for any nested lists of objects
-            # Adjust this to taste if it doesn't work anymore,
-            #   maybe by counting opening/closing brackets
-            prev_line = jl.strip().replace("},", "}\n")
+            if t == b"[" or t == b"{":
+                depth += 1
+                if depth == 2 and t == b"{":
+                    rec_start = m.start()
+                    if nl is None or -1 < nl < pos:
+                        nl = buf.find(b"\n", pos)
+                    if nl != -1 and nl > slow_until:
+                        line = buf[rec_start:nl].rstrip().rstrip(b",")
+                        try:
+                            if type(orjson.loads(line)) is dict:
+                                yield line
+                                depth -= 1
+                                rec_start = None
+                                pos = nl
+                                continue
+                        except orjson.JSONDecodeError:
+                            pass
+                        slow_until = nl
+            else:
+                depth -= 1
+                if depth == 1 and rec_start is not None:
+                    yield buf[rec_start : m.end()]
+                    rec_start = None
+        else:
+            pos = len(buf)
+
+        keep = pos if rec_start is None else rec_start
+        buf = buf[keep:]
+        pos -= keep
+        slow_until -= keep
+        if rec_start is not None:
+            rec_start = 0
+
+    if depth != 0 or rec_start is not None or buf.strip():
+        raise ValueError("json array ended in the middle of a record")
+
+
+def to_ndjson(json_f: Path, ndjson_f: Path = Path("./mod_proxy_urls.ndjson")):
+    with json_f.open("rb") as j, ndjson_f.open("wb", buffering=2**24) as ndj:
+        for rec in iter_records(j):
+            if b"\n" in rec or b"\r" in rec:
+                # pretty printed records need to be squashed onto one line
+                rec = orjson.dumps(orjson.loads(rec))
+            ndj.write(rec)
+            ndj.write(b"\n")
 
-    with ndjson_f.open("r") as ndj:
-        for ndjl in ndj.readlines()[:10]:
-            # sanity checking the json viability
-            orjson.loads(ndjl)
 
+if is_notebook:
+    # sanity checking against the shapes that broke the line based version
+    import io
+
+    nested = [
+        {
+            "id": "0b6a1ba4-3d63-4b9c-9a0c-d2c5e6ee3f43",
+            "holdingsStatements": [
+                {"statement": "v.1-10", "note": "see {v.11},", "staffNote": ""},
+                {"statement": '"quoted" \\ slashed', "note": "}, ] [ {"},
+            ],
+            "electronicAccess": [
+                {"uri": "https://proxy.example.edu/login?url=x", "linkText": "},"}
+            ],
+            "notes": [{"note": "multi\nline", "staffOnly": False}],
+        },
+        None,
+        {"id": "7e1bd5a6-41fa-4a31-a7ab-5f0bd0bd0b9e", "formerIds": []},
+        None,
+    ]
+    for raw in [orjson.dumps(nested), orjson.dumps(nested, option=orjson.OPT_INDENT_2)]:
+        for read_size in [1, 7, 64, 2**24]:
+            recs = [orjson.loads(r) for r in iter_records(io.BytesIO(raw), read_size)]
+            assert recs == [n for n in nested if n is not None], read_size
 
 to_ndjson(Path("./mod_proxy_urls.json"))
 print("ndjson conversion done...")
 
+# %%
+import mmap
+import os
+from array import array
+from pathlib import Path
+
+
+class NdjsonIndex:
+    # The byte offset of every line in an ndjson file over a read-only mmap,
+    #   built once and kept next to the file as <file>.idx.
+    # index[10:20] gives those raw lines without reading the rest of the file
+    #   and shards() splits it into line aligned byte ranges.
+    def __init__(self, ndjson_f: Path):
+        self._f = ndjson_f.open("rb")
+        size = os.fstat(self._f.fileno()).st_size
+        self._mm = (
+            mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        )
+
+        # 8 bytes a line, line i is offsets[i]:offsets[i + 1]
+        self.offsets = array("Q")
+        idx_f = ndjson_f.with_name(ndjson_f.name + ".idx")
+        if idx_f.exists() and idx_f.stat().st_mtime >= ndjson_f.stat().st_mtime:
+            with idx_f.open("rb") as i:
+                self.offsets.frombytes(i.read())
+        if len(self.offsets) == 0 or self.offsets[-1] != size:
+            self.offsets = array("Q", [0])
+            pos = 0
+            while (pos := self._mm.find(b"\n", pos) + 1) > 0:
+                self.offsets.append(pos)
+            if self.offsets[-1] != size:
+                # no newline at the end
+                self.offsets.append(size)
+            with idx_f.open("wb") as i:
+                self.offsets.tofile(i)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int | slice) -> bytes | list[bytes]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._mm[self.offsets[i] : self.offsets[i + 1]]
+
+    def shards(self, n: int) -> list[tuple[int, int]]:
+        # n byte ranges with about the same number of lines in each
+        lines = len(self)
+        bounds = [self.offsets[lines * i // n] for i in range(n + 1)]
+        return [(s, e) for s, e in zip(bounds, bounds[1:]) if e > s]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._f.close()
+
+
+if is_notebook:
+    with NdjsonIndex(Path("./mod_proxy_urls.ndjson")) as index:
+        print(f"{len(index)} holdings")
+        print(index[0])
+
 # %%
 import os
 from contextlib import contextmanager
@@ -69,6 +215,11 @@ from pyfolioclient import FolioBaseClient
 
 @contextmanager
 def get_client(env: str = "DEV"):
+    if env == "FAKE":
+        # the offline stand-in below, for benchmarking without a FOLIO
+        with FakeFolio(fake_folio) as folio:
+            yield folio
+        return
     load_dotenv(override=True)
     fep = os.getenv(f"FOLIO_ENDPOINT_{env}")
     fte = os.getenv(f"FOLIO_TENANT_{env}")
@@ -83,98 +234,1071 @@ if is_notebook:
         print("ok connection!")
 
 # %%
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import orjson
+from pyfolioclient import FolioBaseClient
+
+
+class FakeBatchEndpoint:
+    # Just enough of FOLIO to run the import against: login/logout,
+    #   /holdings-storage/batch/synchronous and the holdings _version lookup.
+    # Whether a record fails is decided by its id so it fails the same way
+    #   on every retry, like a real bad record.
+    def __init__(
+        self,
+        request_latency: float = 0.05,
+        record_latency: float = 0.002,
+        failure_rate: float = 0.0,
+        conflict_rate: float = 0.0,
+        max_concurrency: int = 8,
+        name_failures: bool = True,
+        bad_ids: set[str] | None = None,
+    ):
+        self.request_latency = request_latency
+        self.record_latency = record_latency
+        self.failure_rate = failure_rate
+        self.bad_ids = bad_ids or set()
+        self.conflict_rate = conflict_rate
+        # requests past this queue up like they would in front of okapi
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        # FOLIO doesn't always say which record it didn't like
+        self.name_failures = name_failures
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._concurrent = 0
+
+    def _roll(self, id: str, salt: str) -> float:
+        return random.Random(id + salt).random()
+
+    def _version(self, id: str) -> int:
+        return 2 if self._roll(id, "409") < self.conflict_rate else 1
+
+    def handle(self, req: httpx.Request) -> httpx.Response:
+        if req.url.path == "/authn/login-with-expiry":
+            expires = datetime.now(timezone.utc) + timedelta(minutes=10)
+            return httpx.Response(
+                201,
+                json={"accessTokenExpiration": expires.isoformat()},
+                headers=[
+                    ("set-cookie", "folioAccessToken=fake; Path=/"),
+                    ("set-cookie", "folioRefreshToken=fake; Path=/"),
+                ],
+            )
+        if req.url.path == "/authn/logout":
+            return httpx.Response(204)
+        if req.method == "GET" and req.url.path == "/holdings-storage/holdings":
+            ids = re.findall(r"[0-9a-fA-F-]{36}", req.url.params["query"])
+            return httpx.Response(
+                200,
+                json={
+                    "holdingsRecords": [
+                        {"id": id, "_version": self._version(id)} for id in ids
+                    ]
+                },
+            )
+        if req.url.path != "/holdings-storage/batch/synchronous":
+            return httpx.Response(404)
+
+        with self.slots:
+            with self._lock:
+                self._concurrent += 1
+                self.stats["requests"] += 1
+                self.stats["peak_concurrency"] = max(
+                    self.stats["peak_concurrency"], self._concurrent
+                )
+            try:
+                recs = orjson.loads(req.content)["holdingsRecords"]
+                time.sleep(self.request_latency + self.record_latency * len(recs))
+            except orjson.JSONDecodeError:
+                return httpx.Response(400, text="Bad JSON")
+            finally:
+                with self._lock:
+                    self._concurrent -= 1
+
+        for r in recs:
+            id = r.get("id", "")
+            if id in self.bad_ids or self._roll(id, "422") < self.failure_rate:
+                self.stats["failed"] += 1
+                return httpx.Response(
+                    422,
+                    json={
+                        "errors": [
+                            {
+                                "message": "must not be null",
+                                "parameters": [
+                                    {"key": "id", "value": id}
+                                    if self.name_failures
+                                    else {"key": "permanentLocationId"}
+                                ],
+                            }
+                        ]
+                    },
+                )
+            version = self._version(id)
+            if version > 1 and r.get("_version") != version:
+                self.stats["conflicts"] += 1
+                return httpx.Response(
+                    409,
+                    text=(
+                        f"Cannot update record {id} because it has been changed"
+                        f" (optimistic locking): Stored _version is {version},"
+                        f" _version of request is {r.get('_version')}"
+                    ),
+                )
+        self.stats["records"] += len(recs)
+        return httpx.Response(201)
+
+
+class FakeFolio(FolioBaseClient):
+    # the real pyfolioclient with its http client pointed at a FakeBatchEndpoint
+    def __init__(self, endpoint: FakeBatchEndpoint):
+        self._endpoint = endpoint
+        super().__init__("http://fake-folio", "fake", "fake", "fake")
+
+    def _retrieve_token(self, refresh: bool = False):
+        if not hasattr(self, "_faked"):
+            self._faked = True
+            headers = self.client.headers
+            self.client.close()
+            self.client = httpx.Client(
+                transport=httpx.MockTransport(self._endpoint.handle), headers=headers
+            )
+        return super()._retrieve_token(refresh)
+
+
+fake_folio = FakeBatchEndpoint()
+
+# %%
+import re
+from collections import Counter
 from pathlib import Path
 
 import orjson
 from pyfolioclient import BadRequestError, UnprocessableContentError
+from pyfolioclient._decorators import exception_handler
+
 
+@exception_handler
+def post_json(folio, endpoint: str, content: bytes, params: dict | None = None):
+    # pyfolioclient requires a dict and doesn't take the raw json string : /
+    # its content= path sends octet-stream so go around it with the same
+    #   (already logged in) httpx client and error handling
+    folio._manage_token()
+    res = folio.client.post(
+        folio._base_url + endpoint,
+        content=content,
+        params=params,
+        headers={"Content-Type": "application/json"},
+        timeout=folio.timeout,
+    )
+    res.raise_for_status()
 
-def do_bulk_update(folio, holdings: list[str]):
+
+def failed_record(h: bytes, error: str):
+    # this is the only place a record gets decoded
+    try:
+        rec = orjson.loads(h)
+    except orjson.JSONDecodeError as e:
+        return (None, h.decode(errors="replace"), f"{error}\n{e}")
+    if isinstance(rec, dict) and "id" in rec:
+        return (rec["id"], None, error)
+    return (None, h.decode(), error)
+
+
+# FOLIO usually names the record it didn't like, 422s have the id in the
+#   error parameters and 409s have it in the message
+_uuids = re.compile(rb"[0-9a-fA-F]{8}-(?:[0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}")
+
+
+conflict_error = "Client error '409 Conflict'"
+
+
+def records_with_ids(holdings: list[bytes], ids: set[bytes]) -> set[int]:
+    found = set()
+    for i, h in enumerate(holdings):
+        # records mention instance/location ids too so it only counts
+        #   when it's the holding's own id
+        if any(u in h for u in ids):
+            try:
+                if orjson.loads(h)["id"].encode() in ids:
+                    found.add(i)
+            except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError):
+                pass
+    return found
+
+
+def named_records(e: Exception, holdings: list[bytes]) -> set[int]:
+    res = getattr(e.__cause__, "response", None)
+    if res is None:
+        return set()
+    return records_with_ids(holdings, set(_uuids.findall(res.content)))
+
+
+def record_error(e: Exception) -> bool:
+    # Only a 4xx is FOLIO saying something about the records in the batch.
+    # Anything else (timeouts, dropped connections, 5xx, a token that stopped
+    #   working) is the request failing, that gets raised instead so the batch
+    #   isn't journaled and the rerun sends it again.
+    if isinstance(e, (BadRequestError, UnprocessableContentError)):
+        return True
+    res = getattr(e.__cause__, "response", None)
+    return (
+        res is not None
+        and 400 <= res.status_code < 500
+        and res.status_code not in (401, 403, 408, 429)
+    )
+
+
+def do_bulk_update(folio, holdings: list[bytes], stats: Counter | None = None):
+    stats = Counter() if stats is None else stats
     try:
         hc = len(holdings)
-        folio.post_data(
+        stats["requests"] += 1
+        post_json(
+            folio,
             "/holdings-storage/batch/synchronous",
+            b'{"holdingsRecords":[' + b",".join(holdings) + b"]}",
             params={"upsert": "true"},
-            # pyfolioclient requires a dict and doesn't take the raw json string : /
-            payload=orjson.loads('{ "holdingsRecords": [' + ", ".join(holdings) + "]}"),
         )
-    except (
-        BadRequestError,
-        UnprocessableContentError,
-        RuntimeError,
-        TimeoutError,
-    ) as e:
+    except (BadRequestError, UnprocessableContentError, RuntimeError) as e:
+        if not record_error(e):
+            raise
+        error = str(e.__cause__ if hasattr(e, "__cause__") else e)
         if hc == 1:
-            h = orjson.loads(holdings[0])
-            yield (
-                h.get("id"),
-                None if "id" in h else holdings[0],
-                str(e.__cause__ if hasattr(e, "__cause__") else e),
-            )
+            stats["bad_records"] += 1
+            yield failed_record(holdings[0], error)
             return
-        yield from do_bulk_update(folio, holdings[: hc // 2])
-        yield from do_bulk_update(folio, holdings[hc // 2 :])
-    except orjson.JSONDecodeError as e:
-        if hc == 1:
-            yield (None, holdings[0], str(e))
+
+        # dropping the named record(s) and retrying the rest is one round trip
+        #   instead of the ~2*log2(n) it takes to bisect down to it
+        named = named_records(e, holdings)
+        if 0 < len(named) < hc:
+            stats["bad_records"] += len(named)
+            stats["named_records"] += len(named)
+            yield from (failed_record(holdings[i], error) for i in sorted(named))
+            yield from do_bulk_update(
+                folio, [h for i, h in enumerate(holdings) if i not in named], stats
+            )
             return
-        yield from do_bulk_update(folio, holdings[: hc // 2])
-        yield from do_bulk_update(folio, holdings[hc // 2 :])
-    except Exception as e:
-        yield from ((orjson.loads(h).get("id"), h, str(e)) for h in holdings)
+
+        stats["bisections"] += 1
+        yield from do_bulk_update(folio, holdings[: hc // 2], stats)
+        yield from do_bulk_update(folio, holdings[hc // 2 :], stats)
 
 
 if is_notebook:
     ndjson_f = Path("./mod_proxy_urls.ndjson")
-    with get_client() as folio, ndjson_f.open("r") as ndj:
-        holdings = []
-        for ndjl in ndj.readlines()[10:20]:
-            holdings.append(ndjl)
-        print([e for e in do_bulk_update(folio, holdings)])
+    with get_client() as folio, NdjsonIndex(ndjson_f) as index:
+        print([e for e in do_bulk_update(folio, index[10:20])])
 
 # %%
-from datetime import datetime
-from itertools import chain, islice
 from pathlib import Path
 
-import orjson
 import polars as pl
 
+# what FOLIO will refuse a holding over anyway, adjust to taste
+required = ["id", "instanceId", "permanentLocationId"]
+uuid_fields = required + [
+    "temporaryLocationId",
+    "holdingsTypeId",
+    "callNumberTypeId",
+    "sourceId",
+]
+# how many lines get checked at a time, only the ids are kept past that
+preflight_lines = 100_000
+# same pattern as the uuid fields in the FOLIO schemas
+uuid_re = r"^[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[1-5][a-fA-F0-9]{3}-[89abAB][a-fA-F0-9]{3}-[a-fA-F0-9]{12}$"
+
+
+def preflight(ndjson_f: Path) -> tuple[pl.DataFrame, dict[int, str]]:
+    # Finds the records FOLIO would reject before sending anything, keyed by
+    #   their byte offset in the ndjson.
+    # Returns the rejects as error rows and the offsets of records sharing an
+    #   id with another record so they can be kept out of the same batch.
+    # scan_ndjson gives up on the first malformed line so the lines are read
+    #   as plain strings and the fields pulled out with json paths.
+    # The offsets come from NdjsonIndex rather than polars, it drops the \r
+    #   of a \r\n and skips blank lines which throws every offset after off.
+    raw = pl.col("raw")
+    checks = [
+        pl.when(pl.col(f).is_null()).then(pl.lit(f"missing {f}")) for f in required
+    ] + [
+        pl.when(pl.col(f).str.contains(uuid_re).not_()).then(
+            pl.lit(f"{f} is not a valid uuid")
+        )
+        for f in uuid_fields
+    ]
+    rejects = []
+    ids = []
+    with NdjsonIndex(ndjson_f) as index:
+        for i in range(0, len(index), preflight_lines):
+            offsets = []
+            lines = []
+            chunk = slice(i, i + preflight_lines)
+            for o, line in zip(index.offsets[chunk], index[chunk]):
+                # blank lines aren't records, import_ndjson skips them too
+                if line.strip():
+                    offsets.append(o)
+                    lines.append(line.rstrip(b"\r\n").decode(errors="replace"))
+            records = (
+                pl.DataFrame(
+                    {"offset": offsets, "raw": lines},
+                    schema={"offset": pl.Int64, "raw": pl.Utf8},
+                )
+                .lazy()
+                .with_columns(
+                    **{f: raw.str.json_path_match(f"$.{f}") for f in uuid_fields}
+                )
+                .with_columns(
+                    error=pl.concat_str(checks, separator="; ", ignore_nulls=True)
+                )
+                .select(
+                    "offset",
+                    "id",
+                    pl.when(pl.col("id").is_null()).then(raw).alias("body"),
+                    pl.when(pl.col("error") != "").then("error").alias("error"),
+                )
+                .collect()
+            )
+            rejects.append(records.filter(pl.col("error").is_not_null()))
+            ids.append(
+                records.filter(pl.col("error").is_null()).select("offset", "id")
+            )
+
+    schema = {"offset": pl.Int64, "id": pl.Utf8, "body": pl.Utf8, "error": pl.Utf8}
+    rejects = pl.concat([pl.DataFrame(schema=schema), *rejects])
+    ids = pl.concat([pl.DataFrame(schema={"offset": pl.Int64, "id": pl.Utf8}), *ids])
+    dups = ids.filter(pl.col("id").is_duplicated())
+    return rejects, dict(dups.iter_rows())
+
+
+if is_notebook:
+    rejects, dups = preflight(Path("./mod_proxy_urls.ndjson"))
+    rejects.glimpse()
+    print(f"{len(dups)} records share an id")
+
+# %%
+import csv
+import os
+from pathlib import Path
+
+import orjson
+
+
+class ErrorSink:
+    # Error rows go straight into the output csv as batches finish so they're
+    #   on disk while the run is going and nothing piles up in memory.
+    # 409s are someone else having updated the record since the export, they
+    #   aren't errors yet so their original lines go to <output>.conflicts.ndjson
+    #   for resolve_conflicts to retry with a fresh _version.
+    def __init__(self, output_f: Path, keep_bytes: list[int] | None = None):
+        conflicts_f = output_f.with_suffix(".conflicts.ndjson")
+        if keep_bytes is None or not output_f.exists():
+            self._f = output_f.open("w", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._f)
+            self._writer.writerow(["id", "body", "error"])
+            self._conflicts = conflicts_f.open("wb")
+        else:
+            # anything past the last journaled batch is from one that gets re-sent
+            os.truncate(output_f, keep_bytes[0])
+            self._f = output_f.open("a", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._f)
+            if conflicts_f.exists():
+                os.truncate(conflicts_f, keep_bytes[1])
+            self._conflicts = conflicts_f.open("ab")
+        self.written = 0
+        self.conflicts = 0
+        self._dirty = True
+
+    def write(self, rows: list, conflicted: list[bytes] | None = None):
+        for r in rows:
+            if r[2].startswith(conflict_error):
+                continue
+            self._writer.writerow(r)
+            self.written += 1
+            self._dirty = True
+        for h in conflicted or []:
+            self._conflicts.write(h)
+            self.conflicts += 1
+            self._dirty = True
+
+    def sync(self) -> list[int]:
+        # returns how far both files are safely on disk for the journal
+        if self._dirty:
+            for f in [self._f, self._conflicts]:
+                f.flush()
+                os.fsync(f.fileno())
+            self._dirty = False
+        return [
+            os.fstat(self._f.fileno()).st_size,
+            os.fstat(self._conflicts.fileno()).st_size,
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self._f.close()
+        self._conflicts.close()
+
+
+class Journal:
+    # Append-only record of finished batches, one json line per batch with its
+    #   byte range in the ndjson and how far the error csv had gotten.
+    # The first line says which ndjson (and which shard of it) it belongs to.
+    # A batch is only written once every record in it has an answer and its
+    #   errors are synced, and each line is fsync'd, so a crash can lose the
+    #   batches that were in flight (they get re-sent) but never one that finished.
+    def __init__(
+        self, journal_f: Path, ndjson_f: Path, shard: tuple[int, int] | None = None
+    ):
+        header = {"ndjson": ndjson_f.name, "size": ndjson_f.stat().st_size}
+        if shard is not None:
+            header["shard"] = list(shard)
+        self.done: dict[int, int] = {}
+        self.errors_at: list[int] | None = None
+        self.next_batch = 0
+        self.preflighted = False
+
+        resuming = journal_f.exists()
+        if resuming:
+            good = 0
+            with journal_f.open("rb") as j:
+                for i, line in enumerate(j):
+                    try:
+                        entry = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # only the last line can be torn by a crash
+                        if j.read(1):
+                            raise
+                        break
+                    good += len(line)
+                    if i == 0:
+                        if entry != header:
+                            raise ValueError(
+                                f"{journal_f} was started for {entry}, not {header}"
+                            )
+                        continue
+                    self.errors_at = entry["errors_at"]
+                    if "preflight" in entry:
+                        self.preflighted = True
+                        continue
+                    self.done[entry["start"]] = entry["end"]
+                    self.next_batch = max(self.next_batch, entry["batch"] + 1)
+            os.truncate(journal_f, good)
+
+        self._f = journal_f.open("ab")
+        if not resuming:
+            self._append(header)
+
+    def _append(self, entry: dict):
+        self._f.write(orjson.dumps(entry) + b"\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def record_preflight(self, rejected: int, errors_at: list[int]):
+        self._append({"preflight": rejected, "errors_at": errors_at})
+        self.preflighted = True
+
+    def record(self, batch: int, start: int, end: int, errors_at: list[int]):
+        self._append(
+            {"batch": batch, "start": start, "end": end, "errors_at": errors_at}
+        )
+        self.done[start] = end
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self._f.close()
+
+
+# %%
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from pathlib import Path
+
+import orjson
+
+# where the batch size starts, it moves between min and max as the run goes
 chunk_size = 50
+min_chunk_size = 5
+max_chunk_size = 1000
+# seconds a batch should take, bigger batches are fine as long as FOLIO
+#   keeps up with them
+target_latency = 10.0
+# how many batches can be waiting on FOLIO at once, 1 is the old serial behavior
+in_flight = 4
+# a batch taking this many times longer (per record) than the fastest one seen
+#   so far means FOLIO is struggling and we should back off
+slow_factor = 3
+
+
+class BatchSizer:
+    # Clean batches under target_latency grow the batch size by 10%, slow ones
+    #   shrink it to what should fit in target_latency.
+    # Bisecting to a bad record FOLIO didn't name costs ~2*log2(n) round trips
+    #   so it's halved when bisections cluster. A named one is dropped in a
+    #   single retry whatever the size and doesn't count.
+    def __init__(
+        self,
+        size: int = chunk_size,
+        min_size: int = min_chunk_size,
+        max_size: int = max_chunk_size,
+    ):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.failing = 0.0
+
+    def record(self, n: int, took: float, bisections: int):
+        self.failing = 0.7 * self.failing + 0.3 * (bisections > 0)
+        if bisections > 0:
+            if self.failing > 0.5:
+                self.size = self.size // 2
+        elif took > target_latency:
+            self.size = int(n * target_latency / took)
+        else:
+            self.size = self.size + max(1, self.size // 10)
+        self.size = max(self.min_size, min(self.max_size, self.size))
 
 
-def import_ndjson(ndjson_f: Path, output_f: Path):
-    schema = {"id": pl.Utf8, "body": pl.Utf8, "error": pl.Utf8}
-    errors = pl.DataFrame([], schema)
-    with get_client() as folio, ndjson_f.open("r") as ndj:
-        holdings = ndj.readlines()
+def import_ndjson(
+    ndjson_f: Path,
+    output_f: Path,
+    in_flight: int = in_flight,
+    chunk_size: int = chunk_size,
+    adaptive: bool = True,
+    env: str = "DEV",
+    shard: tuple[int, int] | None = None,
+    checks: tuple[list, dict] | None = None,
+) -> Counter:
+    # rerunning with the same output_f picks up where the last run stopped
+    # shard limits it to a byte range of the ndjson and checks is preflight's
+    #   rejects and dups when they've already been worked out
+    stats = Counter()
+    sizer = BatchSizer(chunk_size) if adaptive else BatchSizer(*[chunk_size] * 3)
+    with (
+        ExitStack() as clients,
+        ndjson_f.open("rb") as ndj,
+        Journal(output_f.with_suffix(".journal"), ndjson_f, shard) as journal,
+        ErrorSink(output_f, journal.errors_at) as errors,
+    ):
+        if len(journal.done) > 0:
+            print(f"resuming after {len(journal.done)} finished batches")
+
+        # records that would fail anyway go straight to the errors
+        if checks is None:
+            rejects, dups = preflight(ndjson_f)
+            checks = (list(rejects.iter_rows()), dups)
+        rejects, dups = checks
+        skip = {r[0] for r in rejects}
+        if not journal.preflighted:
+            errors.write([r[1:] for r in rejects])
+            journal.record_preflight(len(rejects), errors.sync())
+        stats["rejected"] = len(rejects)
+
+        start_at, end_at = (0, None) if shard is None else shard
 
         def chunks():
-            iterator = iter(holdings)
-            for first in iterator:
-                yield chain([first], islice(iterator, chunk_size - 1))
+            batch = journal.next_batch
+            offset = start_at
+            ndj.seek(offset)
+            done = iter(sorted(journal.done.items()))
+            next_done = next(done, None)
+            while True:
+                # batches never straddle a finished range, so skipping one is
+                #   just a seek past it
+                if next_done is not None and offset == next_done[0]:
+                    offset = next_done[1]
+                    ndj.seek(offset)
+                    next_done = next(done, None)
+                    continue
 
-        for i, c in enumerate(chunks()):
-            errors.vstack(
-                pl.DataFrame(
-                    list(do_bulk_update(folio, list(c))),
-                    schema=schema,
-                    orient="row",
-                ).filter(
-                    pl.Expr.not_(
-                        pl.col("error").str.starts_with("Client error '409 Conflict'")
-                    )
-                ),
-                in_place=True,
+                start = offset
+                c = []
+                ids = set()
+                while (
+                    len(c) < sizer.size
+                    and (next_done is None or offset < next_done[0])
+                    and (end_at is None or offset < end_at)
+                ):
+                    # a second copy of an id waits for the next batch
+                    if offset in dups:
+                        if dups[offset] in ids:
+                            break
+                        ids.add(dups[offset])
+                    line = ndj.readline()
+                    if not line:
+                        break
+                    if offset not in skip and line.strip():
+                        c.append(line)
+                    offset += len(line)
+                if offset == start:
+                    return
+                if len(c) == 0:
+                    # nothing but rejects before a finished range or the end
+                    journal.record(batch, start, offset, errors.sync())
+                else:
+                    yield batch, start, offset, c, ids
+                batch += 1
+
+        # pyfolioclient's token refresh isn't thread safe so every worker
+        #   gets its own session
+        local = threading.local()
+        login = threading.Lock()
+
+        def bulk_update(batch: int, start: int, end: int, c: list[bytes]):
+            if not hasattr(local, "folio"):
+                with login:
+                    local.folio = clients.enter_context(get_client(env))
+            batch_stats = Counter(batches=1, records=len(c))
+            call_start = time.monotonic()
+            errs = list(do_bulk_update(local.folio, c, batch_stats))
+            took = time.monotonic() - call_start
+            conflicted = {
+                e[0].encode() for e in errs if e[0] and e[2].startswith(conflict_error)
+            }
+            conflicted = [c[i] for i in sorted(records_with_ids(c, conflicted))]
+            return (batch, start, end), errs, conflicted, took, batch_stats
+
+        done_chunks = 0
+        fastest = None
+        limit = in_flight
+
+        def collect(done):
+            nonlocal done_chunks, fastest, limit
+            failed = None
+            for d in done:
+                # finish journaling the rest before giving up on a failed one
+                if d.exception() is not None:
+                    failed = failed or d.exception()
+                    continue
+                checkpoint, errs, conflicted, took, batch_stats = d.result()
+                errors.write(errs, conflicted)
+                journal.record(*checkpoint, errors.sync())
+                stats.update(batch_stats)
+                sizer.record(batch_stats["records"], took, batch_stats["bisections"])
+
+                # backpressure, fewer batches in flight while FOLIO is slow
+                #   then creeping back up as it recovers
+                # batches with errors spent their time bisecting so don't count
+                if len(errs) == 0:
+                    took = took / batch_stats["records"]
+                    fastest = took if fastest is None else min(fastest, took)
+                    if took > fastest * slow_factor:
+                        limit = max(1, limit // 2)
+                    elif limit < in_flight:
+                        limit += 1
+
+                if done_chunks % 5 == 0:
+                    print(f"{stats['records']} (batch size {sizer.size})")
+                done_chunks += 1
+            if failed is not None:
+                raise failed
+
+        with ThreadPoolExecutor(in_flight) as pool:
+            pending = set()
+            # the ids with more than one copy each pending batch is sending
+            sending = {}
+            try:
+                for *c, ids in chunks():
+                    # a later copy of an id only goes once the batch with the
+                    #   earlier copy is done so the later one is what sticks
+                    while any(ids & sending[p] for p in pending if p in sending):
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    sending = {p: sending[p] for p in pending if p in sending}
+                    p = pool.submit(bulk_update, *c)
+                    pending.add(p)
+                    if len(ids) > 0:
+                        sending[p] = ids
+                    while len(pending) >= limit:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                # out of pending first so a failure here doesn't collect them twice
+                done, pending = wait(pending)
+                collect(done)
+            except BaseException:
+                # batches that already made it to FOLIO still get journaled
+                #   so the rerun doesn't send them again
+                for p in pending:
+                    p.cancel()
+                collect(
+                    {
+                        d
+                        for d in wait(pending).done
+                        if not d.cancelled() and d.exception() is None
+                    }
+                )
+                raise
+
+    stats["conflicts"] = errors.conflicts
+    # every batch costs one request, anything on top of that was spent
+    #   finding the bad records
+    print(dict(stats))
+    if stats["bad_records"] > 0:
+        extra = stats["requests"] - stats["batches"]
+        print(f"{extra / stats['bad_records']:.2f} round trips per bad record")
+    return stats
+
+
+# %%
+import csv
+import re
+from collections import Counter
+from pathlib import Path
+
+import orjson
+
+# how many ids go into one id==(a or b ...) lookup
+lookup_size = 50
+# records can get changed again between the lookup and the retry
+conflict_rounds = 3
+
+_version_field = re.compile(rb'"_version"\s*:\s*\d+')
+
+
+def set_version(h: bytes, version: int) -> bytes:
+    # holdings don't nest _version anywhere so the first one is the record's
+    v = b'"_version":%d' % version
+    h, n = _version_field.subn(v, h, count=1)
+    return h if n > 0 else h.replace(b"{", b"{" + v + b",", 1)
+
+
+def resolve_conflicts(output_f: Path, env: str = "DEV"):
+    # Retries the records that got a 409 during import_ndjson with the
+    #   _version FOLIO currently has for them, anything that still fails ends
+    #   up in the output csv like any other error.
+    conflicts_f = output_f.with_suffix(".conflicts.ndjson")
+    if not conflicts_f.exists():
+        return
+    with conflicts_f.open("rb") as c:
+        holdings = c.readlines()
+    print(f"resolving {len(holdings)} conflicts")
+
+    stats = Counter()
+    with (
+        get_client(env) as folio,
+        output_f.open("a", newline="", encoding="utf-8") as out,
+    ):
+        errors = csv.writer(out)
+        for _ in range(conflict_rounds):
+            if len(holdings) == 0:
+                break
+            # a later copy of the same id wins, same as it does in the import
+            #   where it isn't sent until the earlier copy's batch is done
+            # shards don't wait on each other though, with processes > 1 copies
+            #   in different shards can land in either order
+            by_id = {orjson.loads(h)["id"]: h for h in holdings}
+
+            ids = list(by_id)
+            versions = {}
+            for i in range(0, len(ids), lookup_size):
+                lookup = ids[i : i + lookup_size]
+                for h in folio.get_data(
+                    "/holdings-storage/holdings",
+                    key="holdingsRecords",
+                    cql_query=f"id==({' or '.join(lookup)})",
+                    limit=len(lookup),
+                ):
+                    versions[h["id"]] = h["_version"]
+
+            retry = []
+            for id, h in by_id.items():
+                if id in versions:
+                    retry.append(set_version(h, versions[id]))
+                else:
+                    errors.writerow((id, None, "not found when refreshing _version"))
+
+            holdings = []
+            for i in range(0, len(retry), chunk_size):
+                c = retry[i : i + chunk_size]
+                errs = list(do_bulk_update(folio, c, stats))
+                conflicted = {
+                    e[0].encode()
+                    for e in errs
+                    if e[0] and e[2].startswith(conflict_error)
+                }
+                holdings.extend(c[j] for j in sorted(records_with_ids(c, conflicted)))
+                errors.writerows(
+                    e for e in errs if not (e[0] and e[0].encode() in conflicted)
+                )
+
+        for h in holdings:
+            errors.writerow(
+                (
+                    orjson.loads(h)["id"],
+                    None,
+                    f"{conflict_error} after {conflict_rounds} _version refreshes",
+                )
             )
-            if i % 5 == 0:
-                print(i * chunk_size)
 
-    errors.write_csv(output_f)
+    print(f"{stats['requests']} requests, {len(holdings)} still conflicting")
+    return stats
+
+
+# %%
+import multiprocessing
+import shutil
+from collections import Counter
+from pathlib import Path
+
+# how many processes split the ndjson between them, each with its own
+#   FOLIO session and in_flight batches
+processes = 1
 
 
+def _run_shard(q, *args, **kwargs):
+    q.put(import_ndjson(*args, **kwargs))
+
+
+def import_sharded(
+    ndjson_f: Path, output_f: Path, processes: int = processes, **import_args
+) -> Counter:
+    # Gives every process its own line aligned byte range of the ndjson and its
+    #   own journal/errors as <output>.<n>.csv, which get stitched into
+    #   output_f at the end. Rerunning with the same output_f and number of
+    #   processes resumes every shard.
+    # This forks so the notebook's functions come along, windows doesn't
+    #   have fork and has to stick with processes = 1.
+    # Copies of an id only wait on each other within a shard, if the ndjson
+    #   has them far apart which one FOLIO ends up with is a coin flip.
+    with NdjsonIndex(ndjson_f) as index:
+        shards = index.shards(processes)
+    # preflight runs once up here so the shards never touch polars after the fork
+    rejects, dups = preflight(ndjson_f)
+    rejects = list(rejects.iter_rows())
+
+    ctx = multiprocessing.get_context("fork")
+    q = ctx.Queue()
+    procs = []
+    shard_fs = []
+    for n, (start, end) in enumerate(shards):
+        shard_f = output_f.with_name(f"{output_f.stem}.{n}{output_f.suffix}")
+        shard_fs.append(shard_f)
+        checks = (
+            [r for r in rejects if start <= r[0] < end],
+            {o: id for o, id in dups.items() if start <= o < end},
+        )
+        p = ctx.Process(
+            target=_run_shard,
+            args=(q, ndjson_f, shard_f),
+            kwargs={"shard": (start, end), "checks": checks, **import_args},
+        )
+        p.start()
+        procs.append(p)
+
+    for p in procs:
+        p.join()
+    if any(p.exitcode != 0 for p in procs):
+        raise RuntimeError(f"a shard failed, rerun with {output_f} to resume")
+    stats = Counter()
+    for _ in procs:
+        stats.update(q.get())
+
+    with (
+        output_f.open("wb") as out,
+        output_f.with_suffix(".conflicts.ndjson").open("wb") as conflicts,
+    ):
+        for i, shard_f in enumerate(shard_fs):
+            with shard_f.open("rb") as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+            with shard_f.with_suffix(".conflicts.ndjson").open("rb") as f:
+                shutil.copyfileobj(f, conflicts)
+    return stats
+
+
+# %%
+from datetime import datetime
+from pathlib import Path
+
+# retry the 409s with a fresh _version instead of leaving them for a manual re-run
+resolve_409s = True
+
 output = Path(datetime.now().strftime("%m%d%H%M%S") + ".csv")
-import_ndjson(Path("./mod_proxy_urls.ndjson"), output)
+# to resume a run that died point this at its output instead
+# output = Path("0101120000.csv")
+if processes > 1:
+    import_sharded(Path("./mod_proxy_urls.ndjson"), output)
+else:
+    import_ndjson(Path("./mod_proxy_urls.ndjson"), output)
+if resolve_409s:
+    resolve_conflicts(output)
 print(f"{output} done!")
 
 # %%
+import multiprocessing
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+
+import orjson
+import polars as pl
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+# flip this on to run import_ndjson against the fake instead of FOLIO
+benchmark = False
+bench_records = 20000
+bench_chunk_sizes = [10, 50, 200]
+bench_in_flight = [1, 4, 8]
+bench_server = {
+    "request_latency": 0.05,
+    "record_latency": 0.002,
+    "failure_rate": 0.002,
+    "conflict_rate": 0.002,
+    "max_concurrency": 8,
+}
+
+
+def fake_holdings(ndjson_f: Path, n: int):
+    # nested the way our holdings are so the payload sizes are realistic
+    with ndjson_f.open("wb") as f:
+        for i in range(n):
+            h = {
+                "id": str(uuid.uuid4()),
+                "instanceId": str(uuid.uuid4()),
+                "permanentLocationId": str(uuid.uuid4()),
+                "hrid": f"ho{i:08}",
+                "holdingsStatements": [{"statement": f"v.{i}", "note": "}, {"}],
+                "electronicAccess": [
+                    {
+                        "uri": f"https://proxy.example.edu/login?url=https://example.com/{i}",
+                        "linkText": "Online access",
+                        "relationshipId": str(uuid.uuid4()),
+                    }
+                ],
+                "notes": [],
+            }
+            f.write(orjson.dumps(h) + b"\n")
+
+
+def peak_rss() -> int:
+    # ru_maxrss is KiB on linux and bytes on macos
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+
+
+def bench_once(ndjson_f: Path, run: str, **import_args) -> dict:
+    global fake_folio
+    fake_folio = FakeBatchEndpoint(**bench_server)
+    output_f = ndjson_f.with_name(f"{run}.csv")
+    # a forked process starts out with the notebook's rss already counted,
+    #   only what the import adds on top of that is its own
+    baseline = peak_rss()
+    start = time.perf_counter()
+    stats = import_ndjson(ndjson_f, output_f, env="FAKE", **import_args)
+    took = time.perf_counter() - start
+    rss = peak_rss() - baseline
+    return {
+        "run": run,
+        "records_per_s": stats["records"] / took,
+        "requests": stats["requests"],
+        "bad_records": stats["bad_records"],
+        "round_trips_per_bad": (stats["requests"] - stats["batches"])
+        / max(1, stats["bad_records"]),
+        "peak_concurrency": fake_folio.stats["peak_concurrency"],
+        "peak_rss_mb": rss / (2**20 if sys.platform == "darwin" else 2**10),
+    }
+
+
+def bench_isolated(ndjson_f: Path, run: str, **import_args) -> dict:
+    # peak rss only ever goes up so each run gets a fresh forked process,
+    #   without one a run only shows memory past the earlier runs' peak
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return bench_once(ndjson_f, run, **import_args)
+    # polars' thread pool doesn't survive a fork so preflight has to happen
+    #   out here, same as import_sharded
+    if import_args.get("checks") is None:
+        rejects, dups = preflight(ndjson_f)
+        import_args["checks"] = (list(rejects.iter_rows()), dups)
+    ctx = multiprocessing.get_context("fork")
+    q = ctx.Queue()
+    p = ctx.Process(target=lambda: q.put(bench_once(ndjson_f, run, **import_args)))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        raise RuntimeError(f"benchmark run {run} failed")
+    return q.get()
+
+
+def bench_bisection(n: int = 50, bad: int = 1) -> list[dict]:
+    # round trips do_bulk_update needs for one batch, with and without
+    #   FOLIO naming the bad record in its response
+    global fake_folio
+    rows = []
+    ids = [str(uuid.uuid4()) for _ in range(n)]
+    batch = [orjson.dumps({"id": id}) for id in ids]
+    for named in [True, False]:
+        fake_folio = FakeBatchEndpoint(
+            request_latency=0,
+            record_latency=0,
+            name_failures=named,
+            bad_ids=set(random.sample(ids, bad)),
+        )
+        stats = Counter()
+        with get_client("FAKE") as folio:
+            errs = list(do_bulk_update(folio, batch, stats))
+        rows.append(
+            {
+                "named": named,
+                "batch": n,
+                "bad": len(errs),
+                "round_trips_per_bad": (stats["requests"] - 1) / max(1, len(errs)),
+            }
+        )
+    return rows
+
+
+if benchmark:
+    with tempfile.TemporaryDirectory() as tmp:
+        ndjson_f = Path(tmp) / "bench.ndjson"
+        fake_holdings(ndjson_f, bench_records)
+        rejects, dups = preflight(ndjson_f)
+        checks = (list(rejects.iter_rows()), dups)
+
+        results = []
+        for cs in bench_chunk_sizes:
+            for inf in bench_in_flight:
+                for adaptive in [False, True]:
+                    run = f"{cs}_{inf}_{'adaptive' if adaptive else 'fixed'}"
+                    print(run)
+                    results.append(
+                        bench_isolated(
+                            ndjson_f,
+                            run,
+                            chunk_size=cs,
+                            in_flight=inf,
+                            adaptive=adaptive,
+                            checks=checks,
+                        )
+                    )
+
+    results = pl.DataFrame(results)
+    with pl.Config(tbl_rows=-1):
+        print(results)
+        print(pl.DataFrame(bench_bisection()))
+    results.write_csv("benchmark.csv")
+
+# %%
@@ -16,8 +16,6 @@
 # %conda env update -n base --file environment.yaml
 
 # %%
-import io
-import shutil
 import time
 import uuid
 from pathlib import Path
@@ -39,6 +37,133 @@ fte = os.getenv(f"FOLIO_TENANT_{env}")
 fun = os.getenv(f"FOLIO_USER_{env}")
 fpw = os.getenv(f"FOLIO_PASSWORD_{env}")
 
+# %%
+import json
+import threading
+from collections import Counter
+
+from pyfolioclient._decorators import exception_handler
+
+# shared by every cell and thread, keep it above the busiest stage's workers
+max_connections = 16
+# needs h2, which comes with httpx[http2]
+http2 = False
+
+
+class FolioSession(FolioBaseClient):
+    # One login and one connection pool for the whole notebook, safe to share
+    #   between threads. The token gets refreshed a minute early under a lock
+    #   so only one thread ever does it, and the MARC downloads get their own
+    #   pool without the okapi headers.
+    # metrics counts requests, responses by status and new connections. Every
+    #   request can reuse a pooled connection, so connections getting close to
+    #   requests means the pool is churning.
+    TOKEN_REFRESH_BUFFER = 60
+
+    def __init__(self, *args, **kwargs):
+        self._token_lock = threading.RLock()
+        self._metrics_lock = threading.Lock()
+        self.metrics = Counter()
+        self._pooled = False
+        super().__init__(*args, **kwargs)
+        self.downloads = self._pooled_client()
+
+    def _pooled_client(self, headers=None) -> httpx.Client:
+        return httpx.Client(
+            headers=headers,
+            timeout=self.timeout,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            event_hooks={
+                "request": [self._on_request],
+                "response": [self._on_response],
+            },
+        )
+
+    def _count(self, metric: str):
+        with self._metrics_lock:
+            self.metrics[metric] += 1
+
+    def _on_request(self, request: httpx.Request):
+        self._count("requests")
+        request.extensions["trace"] = self._on_trace
+
+    def _on_response(self, response: httpx.Response):
+        self._count(f"{response.status_code // 100}xx")
+
+    def _on_trace(self, event: str, info: dict):
+        if event == "connection.connect_tcp.complete":
+            self._count("connections")
+        elif event == "connection.start_tls.complete":
+            self._count("tls_handshakes")
+
+    def _retrieve_token(self, refresh: bool = False):
+        # pyfolioclient makes a plain Client, swapped for the pooled one
+        #   before the first login goes out
+        if not self._pooled:
+            self._pooled = True
+            headers = self.client.headers
+            self.client.close()
+            self.client = self._pooled_client(headers)
+        return super()._retrieve_token(refresh)
+
+    def _manage_token(self):
+        with self._token_lock:
+            super()._manage_token()
+
+    @exception_handler
+    def post_data(
+        self,
+        endpoint: str,
+        payload: dict | None = None,
+        params: dict | None = None,
+        content: bytes | None = None,
+    ) -> dict | int:
+        # pyfolioclient switches the whole client's Content-Type for uploads,
+        #   which other threads would pick up
+        if not content:
+            return super().post_data(endpoint, payload=payload, params=params)
+        self._manage_token()
+        res = self.client.post(
+            f"{self._base_url}{endpoint}",
+            content=content,
+            params=params,
+            headers={"Content-Type": "application/octet-stream"},
+            timeout=self.timeout,
+        )
+        res.raise_for_status()
+        try:
+            return res.json()
+        except json.JSONDecodeError:
+            return int(res.status_code)
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        self.downloads.close()
+
+
+_session = None
+
+
+def folio_session() -> FolioSession:
+    # logs in the first time, every cell after that gets the same session
+    global _session
+    if _session is None:
+        _session = FolioSession(fep, fte, fun, fpw)
+    return _session
+
+
+def close_session():
+    global _session
+    if _session is not None:
+        print(dict(_session.metrics))
+        _session.__exit__(None, None, None)
+        _session = None
+
+
 # %%
 pl.read_csv("./missing_bibs.csv").select(pl.col("item_hrid")).filter(
     pl.Expr.and_(
@@ -48,52 +173,120 @@ pl.read_csv("./missing_bibs.csv").select(pl.col("item_hrid")).filter(
 ).unique().sort("item_hrid").write_csv("./unique_itemids.csv")
 
 # %%
-items = (
-    pl.scan_csv("./unique_itemids.csv")
-    .select(pl.lit('items.hrid="') + pl.col("item_hrid") + pl.lit('"'))
-    .with_row_index()
-)
+from collections.abc import Iterator
+from itertools import islice
 
-instance_ids = pl.DataFrame([], schema={"instance_id": pl.Utf8})
 
-start = time.time()
-batch_size = 100
-rows_batched = batch_size
-batch_num = 0
-with FolioBaseClient(fep, fte, fun, fpw) as folio:
-
-    while rows_batched == batch_size:
-        if batch_num % 100 == 0:
-            print(f"{batch_num}, ", end="")
-        batch = items.filter(
-            pl.Expr.and_(
-                pl.col("index").ge(pl.lit(batch_size * batch_num)),
-                pl.col("index").lt(pl.lit(batch_size * (batch_num + 1))),
-            )
-        )
-        batch_num += 1
-        rows_batched = int(batch.select(pl.len()).collect().item())
-        cql = " or ".join([r["literal"] for r in batch.collect().to_dicts()])
-
-        instance_ids.vstack(
-            pl.DataFrame(
-                [
-                    i["id"]
-                    for i in folio.get_data(
-                        "/search/instances",
-                        key="instances",
-                        cql_query=f'({cql} and staffSuppress=="false")',
-                        limit=batch_size,
-                    )
-                ],
-                schema={"instance_id": pl.Utf8},
-            ),
-            in_place=True,
+def iter_batches(
+    source: str | Path, batch_size: int, sample_size: int | None = None
+) -> Iterator[bytes]:
+    # Reads a single column csv once, yielding batch_size lines at a time.
+    # polars writes one value per line so each batch is already the
+    #   header-less csv data-export wants uploaded.
+    with Path(source).open("rb") as f:
+        f.readline()
+        lines = islice(f, sample_size)
+        while batch := b"".join(islice(lines, batch_size)):
+            yield batch
+
+
+# %%
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+# okapi turns away request lines over 8KiB, this leaves room for the rest of
+#   the url and the other parameters
+max_query_len = 6000
+# mod-search won't return more than 500 instances a page
+max_page = 500
+lookup_threads = 4
+# item hrid -> instance id, with an empty instance id for hrids that didn't
+#   turn up (or are on a suppressed instance) so reruns only ask about new ones
+hrid_cache = Path(f"hrid_cache_{env}.csv")
+
+
+def pack_hrids(hrids: list[str]) -> Iterator[list[str]]:
+    # as many hrids as fit into one query once it's url encoded
+    base = len(quote('() and staffSuppress=="false"'))
+    batch = []
+    size = base
+    for h in hrids:
+        term = len(quote(f'items.hrid="{h}" or '))
+        if len(batch) > 0 and (size + term > max_query_len or len(batch) == max_page):
+            yield batch
+            batch = []
+            size = base
+        batch.append(h)
+        size += term
+    if len(batch) > 0:
+        yield batch
+
+
+def resolve_hrids(folio: FolioBaseClient, hrids: list[str]) -> dict[str, str | None]:
+    # expandAll brings the items along so the instances can be matched back
+    #   to the hrids that found them
+    cql = " or ".join(f'items.hrid="{h}"' for h in hrids)
+    found = dict.fromkeys(hrids)
+    offset = 0
+    while True:
+        page = folio.get_data(
+            "/search/instances",
+            key="instances",
+            params={"expandAll": "true", "offset": str(offset)},
+            cql_query=f'({cql}) and staffSuppress=="false"',
+            limit=max_page,
         )
+        for i in page:
+            for item in i.get("items", []):
+                if item.get("hrid") in found:
+                    found[item["hrid"]] = i["id"]
+        # a full page means there could be more behind it
+        if len(page) < max_page:
+            return found
+        offset += max_page
 
-instance_ids.rechunk().unique("instance_id").sort("instance_id").write_csv(
-    f"unique_instanceids_{env}.csv"
-)
+
+# %%
+start = time.time()
+
+hrids = pl.read_csv("./unique_itemids.csv", schema={"item_hrid": pl.Utf8})
+hrids = hrids["item_hrid"].to_list()
+
+cache = {}
+if hrid_cache.exists():
+    with hrid_cache.open(newline="") as f:
+        cache = {r[0]: r[1] or None for r in list(csv.reader(f))[1:]}
+misses = [h for h in hrids if h not in cache]
+print(f"{len(hrids) - len(misses)} cached, looking up {len(misses)}")
+
+folio = folio_session()
+with (
+    ThreadPoolExecutor(lookup_threads) as pool,
+    hrid_cache.open("a", newline="") as f,
+):
+
+    def lookup(batch: list[str]) -> dict[str, str | None]:
+        return resolve_hrids(folio, batch)
+
+    cached = csv.writer(f)
+    if f.tell() == 0:
+        cached.writerow(["item_hrid", "instance_id"])
+    try:
+        for n, found in enumerate(pool.map(lookup, pack_hrids(misses))):
+            if n % 10 == 0:
+                print(f"{n}, ", end="")
+            cached.writerows(found.items())
+            f.flush()
+            cache.update(found)
+    except BaseException:
+        pool.shutdown(cancel_futures=True)
+        raise
+
+pl.DataFrame(
+    [cache[h] for h in hrids if cache[h] is not None],
+    schema={"instance_id": pl.Utf8},
+).unique("instance_id").sort("instance_id").write_csv(f"unique_instanceids_{env}.csv")
 print()
 print((time.time() - start) / 60)
 
@@ -103,221 +296,604 @@ pl.read_csv(f"unique_instanceids_{env}.csv").with_row_index().filter(
     pl.col("index").lt(pl.lit(2000)),
 ).sort("instance_id").drop("index").write_csv("has_four_failures.csv")
 
+# %%
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+
+state_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY, source TEXT, batch_size INTEGER, started REAL,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS batches (
+    run TEXT, batch_num INTEGER, file_id TEXT, job_id TEXT,
+    PRIMARY KEY (run, batch_num)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY, run TEXT, file_id TEXT, status TEXT,
+    launched REAL, finished REAL
+);
+CREATE TABLE IF NOT EXISTS transitions (job_id TEXT, status TEXT, at REAL);
+CREATE TABLE IF NOT EXISTS downloads (
+    run TEXT, file_name TEXT, size INTEGER, sha256 TEXT,
+    PRIMARY KEY (run, file_name)
+);
+"""
+
+
+def sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(2**20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class RunState:
+    # Every batch, file definition, job, status change and download of a run
+    #   so each cell can skip what's already done after a kernel restart.
+    # Every write is its own transaction, WAL keeps them cheap and lets the
+    #   download threads record files while the notebook reads.
+    def __init__(self, db_f: Path):
+        self.db = sqlite3.connect(db_f, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(state_schema)
+        # state from before runs had a fingerprint
+        columns = {r[1] for r in self.db.execute("PRAGMA table_info(runs)")}
+        if "fingerprint" not in columns:
+            self.db.execute("ALTER TABLE runs ADD COLUMN fingerprint TEXT")
+        self.lock = threading.Lock()
+
+    def execute(self, sql: str, params=()) -> list[tuple]:
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        # a failed statement rolls the rest back, otherwise the connection is
+        #   left inside the transaction and every write after it goes nowhere
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def start_run(self, source: str, batch_size: int) -> uuid.UUID:
+        run = uuid.uuid4()
+        self.execute(
+            "INSERT INTO runs VALUES (?, ?, ?, ?, ?)",
+            (str(run), source, batch_size, time.time(), sha256_file(Path(source))),
+        )
+        return run
+
+    def last_run(self) -> uuid.UUID | None:
+        rows = self.execute("SELECT run FROM runs ORDER BY started DESC LIMIT 1")
+        return uuid.UUID(rows[0][0]) if len(rows) > 0 else None
+
+    def run_source(self, run: uuid.UUID) -> tuple[str, int]:
+        source, batch_size, fingerprint = self.execute(
+            "SELECT source, batch_size, fingerprint FROM runs WHERE run = ?",
+            (str(run),),
+        )[0]
+        # batches are numbered by where they are in the source so resuming
+        #   against a rewritten one would skip the wrong ids
+        if fingerprint is not None and sha256_file(Path(source)) != fingerprint:
+            raise ValueError(
+                f"{source} changed since {run} started, set new_run = True"
+            )
+        return source, batch_size
+
+    def uploaded(self, run: uuid.UUID) -> set[int]:
+        rows = self.execute("SELECT batch_num FROM batches WHERE run = ?", (str(run),))
+        return {r[0] for r in rows}
+
+    def record_upload(self, run: uuid.UUID, batch_num: int, file_id: str, job_id: str):
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO batches VALUES (?, ?, ?, ?)",
+                (str(run), batch_num, file_id, job_id),
+            )
+            db.execute(
+                "INSERT INTO jobs (job_id, run, file_id) VALUES (?, ?, ?)",
+                (job_id, str(run), file_id),
+            )
+
+    def job_ids(self, run: uuid.UUID) -> list[str]:
+        rows = self.execute("SELECT job_id FROM jobs WHERE run = ?", (str(run),))
+        return [r[0] for r in rows]
+
+    def unlaunched(self, run: uuid.UUID) -> list[tuple[str, str]]:
+        return self.execute(
+            "SELECT file_id, job_id FROM jobs WHERE run = ? AND launched IS NULL",
+            (str(run),),
+        )
+
+    def running(self, run: uuid.UUID) -> dict[str, float]:
+        rows = self.execute(
+            "SELECT job_id, launched FROM jobs"
+            " WHERE run = ? AND launched IS NOT NULL AND finished IS NULL",
+            (str(run),),
+        )
+        return dict(rows)
+
+    def finished(self, run: uuid.UUID) -> dict[str, tuple[str, float]]:
+        rows = self.execute(
+            "SELECT job_id, status, finished - launched FROM jobs"
+            " WHERE run = ? AND finished IS NOT NULL",
+            (str(run),),
+        )
+        return {r[0]: (r[1], r[2]) for r in rows}
+
+    def record_launch(self, job_id: str, at: float):
+        self.execute("UPDATE jobs SET launched = ? WHERE job_id = ?", (at, job_id))
+
+    def record_status(self, job_id: str, status: str, at: float, done: bool):
+        # only changes make it into transitions
+        with self.transaction() as db:
+            changed = db.execute(
+                "UPDATE jobs SET status = ?, finished = ?"
+                " WHERE job_id = ? AND status IS NOT ?",
+                (status, at if done else None, job_id, status),
+            ).rowcount
+            if changed > 0:
+                db.execute(
+                    "INSERT INTO transitions VALUES (?, ?, ?)", (job_id, status, at)
+                )
+
+    def downloads(self, run: uuid.UUID) -> dict[str, tuple[int, str]]:
+        rows = self.execute(
+            "SELECT file_name, size, sha256 FROM downloads WHERE run = ?",
+            (str(run),),
+        )
+        return {r[0]: (r[1], r[2]) for r in rows}
+
+    def record_download(self, run: uuid.UUID, file_name: str, size: int, sha256: str):
+        self.execute(
+            "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?)",
+            (str(run), file_name, size, sha256),
+        )
+
+    def summary(self, run: uuid.UUID) -> dict[str, int]:
+        run = str(run)
+        (uploaded,) = self.execute(
+            "SELECT count(*) FROM batches WHERE run = ?", (run,)
+        )[0]
+        statuses = self.execute(
+            "SELECT coalesce(status, 'NOT_LAUNCHED'), count(*) FROM jobs"
+            " WHERE run = ? GROUP BY 1",
+            (run,),
+        )
+        (downloaded,) = self.execute(
+            "SELECT count(*) FROM downloads WHERE run = ?", (run,)
+        )[0]
+        return {"uploaded": uploaded, **dict(statuses), "downloaded": downloaded}
+
+
+state = RunState(Path(f"export_state_{env}.sqlite"))
+
+# %%
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# definition/upload pairs running at once, 1 is the old one-at-a-time loop
+upload_in_flight = 8
+upload_retries = 3
+
+
+def define_and_upload(
+    folio: FolioBaseClient, file_name: str, csv: bytes
+) -> tuple[str, str]:
+    # a retry starts over with a new definition, data-export never looks at
+    #   the ones that didn't get their upload
+    for attempt in range(upload_retries):
+        try:
+            res = folio.post_data(
+                "/data-export/file-definitions",
+                payload={
+                    "size": int(len(csv) / 2**10),
+                    "fileName": file_name,
+                    "uploadFormat": "csv",
+                },
+            )
+            folio.post_data(
+                f"/data-export/file-definitions/{res['id']}/upload", content=csv
+            )
+            return res["id"], res["jobExecutionId"]
+        except (RuntimeError, ConnectionError, TimeoutError, httpx.TransportError) as e:
+            # a 4xx (or a failed login) will just fail again, only server and
+            #   network trouble is worth another go
+            res = getattr(e.__cause__, "response", None)
+            if isinstance(e, RuntimeError) and (res is None or res.status_code < 500):
+                raise
+            if attempt == upload_retries - 1:
+                raise
+            time.sleep(2**attempt)
+
+
 # %%
 start = time.time()
-run = uuid.uuid4()
 
 source = f"unique_instanceids_{env}.csv"
 # source = f"has_four_failures.csv"
 
-job_ids = []
-file_ids = []
 sample_size = 2000000
 batch_size = 100
-rows_batched = batch_size
-batch_num = 0
-with FolioBaseClient(fep, fte, fun, fpw) as folio:
-    instances = pl.scan_csv(source).with_row_index().head(sample_size)
-    while rows_batched == batch_size:
-        if batch_num % 10 == 0:
-            print(f"{batch_num}, ", end="")
-        batch = instances.filter(
-            pl.Expr.and_(
-                pl.col("index").ge(pl.lit(batch_size * batch_num)),
-                pl.col("index").lt(pl.lit(batch_size * (batch_num + 1))),
-            )
-        )
+
+# carries on with the last run's uploads, new_run = True starts a fresh one
+new_run = False
+run = state.last_run()
+if new_run or run is None:
+    run = state.start_run(source, batch_size)
+else:
+    source, batch_size = state.run_source(run)
+uploaded = state.uploaded(run)
+print(f"{run}, {len(uploaded)} batches already uploaded")
+
+folio = folio_session()
+with ThreadPoolExecutor(upload_in_flight) as pool:
+
+    def upload(batch_num: int, csv: bytes) -> tuple[int, str, str]:
         batch_name = f"_{batch_size * batch_num}-{batch_size * (batch_num + 1)}_"
-        batch_num += 1
-        rows_batched = int(batch.select(pl.len()).collect().item())
-
-        csv = io.BytesIO()
-        batch.select("instance_id").collect().write_csv(csv, include_header=False)
-
-        csv.seek(0)
-        req = {
-            "size": int(csv.getbuffer().nbytes / 2**10),
-            "fileName": str(run) + batch_name + ".csv",
-            "uploadFormat": "csv",
-        }
-        csv.seek(0)
-
-        res = folio.post_data("/data-export/file-definitions", payload=req)
-        file_id = res["id"]
-        file_ids.append(file_id)
-        job_ids.append(res["jobExecutionId"])
-
-        res = folio.post_data(
-            f"/data-export/file-definitions/{file_id}/upload", content=csv
+        return batch_num, *define_and_upload(
+            folio, str(run) + batch_name + ".csv", csv
         )
 
+    uploads = 0
+
+    def collect(done):
+        global uploads
+        failed = None
+        for d in done:
+            # record the rest before giving up on a failed one
+            if d.exception() is not None:
+                failed = failed or d.exception()
+                continue
+            state.record_upload(run, *d.result())
+            uploads += 1
+            if uploads % 10 == 0:
+                print(f"{uploads}, ", end="")
+        if failed is not None:
+            raise failed
+
+    pending = set()
+    try:
+        for batch in enumerate(iter_batches(source, batch_size, sample_size)):
+            if batch[0] in uploaded:
+                continue
+            pending.add(pool.submit(upload, *batch))
+            if len(pending) >= upload_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        # out of pending first so a failure here doesn't collect them twice
+        done, pending = wait(pending)
+        collect(done)
+    except BaseException:
+        # uploads that made it still get recorded so the rerun skips them
+        for p in pending:
+            p.cancel()
+        collect(
+            {
+                d
+                for d in wait(pending).done
+                if not d.cancelled() and d.exception() is None
+            }
+        )
+        raise
+
+took = time.time() - start
 print()
-print((time.time() - start) / 60)
+print(took / 60)
+print(f"{uploads / took:.2f} batches/s with {upload_in_flight} in flight")
+print(dict(folio.metrics))
 
 # %%
-start = time.time()
+from collections import deque
 
 concurrency_limit = 4
+# a job-execution lookup is a single id==(a or b ...) query this long
+status_batch = 50
+
+
+def job_statuses(folio: FolioBaseClient, job_ids: list[str]) -> pl.DataFrame:
+    # Status and exported file of every job, status_batch jobs per request.
+    # Jobs that haven't exported anything yet have null file columns.
+    rows = []
+    for i in range(0, len(job_ids), status_batch):
+        lookup = job_ids[i : i + status_batch]
+        offset = 0
+        while True:
+            res = folio.get_data(
+                "/data-export/job-executions",
+                params={"offset": str(offset)},
+                cql_query=f"id==({' or '.join(lookup)})",
+                limit=len(lookup),
+            )
+            for job in res["jobExecutions"]:
+                exported = (job.get("exportedFiles") or [{}])[0]
+                rows.append(
+                    (
+                        job["id"],
+                        job["status"],
+                        exported.get("fileId"),
+                        exported.get("fileName"),
+                    )
+                )
+            offset += len(res["jobExecutions"])
+            if len(res["jobExecutions"]) == 0 or offset >= res["totalRecords"]:
+                break
+    return pl.DataFrame(
+        rows,
+        schema={
+            "id": pl.Utf8,
+            "status": pl.Utf8,
+            "file_id": pl.Utf8,
+            "file_name": pl.Utf8,
+        },
+        orient="row",
+    )
 
-with FolioBaseClient(fep, fte, fun, fpw) as folio:
-    print(f"{len(file_ids)}, ", end="")
-    while len(file_ids) > 0:
-        print(f"{len(file_ids)}, ", end="")
 
-        res = folio.get_data(
-            "/data-export/job-executions",
-            key="jobExecutions",
-            cql_query=f'status="IN_PROGRESS"',
+class ExportScheduler:
+    # Starts exports as soon as one of its own jobs finishes instead of
+    #   checking everything IN_PROGRESS before each one, and polls all of its
+    #   running jobs in one query. Polling slows down while nothing finishes
+    #   and goes back to min_poll as soon as something does.
+    # The run's jobs and how far they got come from the state store so a
+    #   restarted scheduler keeps watching what's already running.
+    done_statuses = {"COMPLETED", "COMPLETED_WITH_ERRORS", "FAIL"}
+
+    def __init__(
+        self,
+        folio: FolioBaseClient,
+        state: RunState,
+        run: uuid.UUID,
+        slots: int = concurrency_limit,
+        min_poll: float = 1.0,
+        max_poll: float = 30.0,
+    ):
+        self.folio = folio
+        self.state = state
+        self.slots = slots
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.queue = deque(state.unlaunched(run))
+        # job id -> when it was launched
+        self.running = state.running(run)
+        # job id -> (status, seconds from launch to done)
+        self.finished = state.finished(run)
+
+    def launch(self):
+        while len(self.queue) > 0 and len(self.running) < self.slots:
+            file_id, job_id = self.queue.popleft()
+            self.folio.post_data(
+                "/data-export/export",
+                payload={
+                    "fileDefinitionId": file_id,
+                    "jobProfileId": "524d3f1b-f008-4c6b-815f-de76620ccd90",
+                    "idType": "instance",
+                },
+            )
+            self.running[job_id] = time.time()
+            self.state.record_launch(job_id, self.running[job_id])
+
+    def check(self) -> int:
+        finished = 0
+        now = time.time()
+        jobs = job_statuses(self.folio, list(self.running))
+        for id, status in jobs.select("id", "status").iter_rows():
+            done = status in self.done_statuses
+            self.state.record_status(id, status, now, done)
+            if done:
+                self.finished[id] = (status, now - self.running.pop(id))
+                finished += 1
+        return finished
+
+    def report(self):
+        took = pl.Series([t for _, t in self.finished.values()], dtype=pl.Float64)
+        print(
+            f"{len(self.queue)} queued, {len(self.running)} running, "
+            f"{len(self.finished)} done",
+            end="",
         )
-        if len(res) <= concurrency_limit:
-            file_id = file_ids.pop()
-            req = {
-                "fileDefinitionId": file_id,
-                "jobProfileId": "524d3f1b-f008-4c6b-815f-de76620ccd90",
-                "idType": "instance",
-            }
-            res = folio.post_data("/data-export/export", payload=req)
-        else:
-            time.sleep(5)
-print()
-print((time.time() - start) / 60)
+        if len(took) > 0:
+            p50, p90, p99 = (took.quantile(q) for q in (0.5, 0.9, 0.99))
+            print(f" (p50 {p50:.0f}s, p90 {p90:.0f}s, p99 {p99:.0f}s)", end="")
+        print()
+
+    def run(self):
+        poll = self.min_poll
+        while len(self.queue) > 0 or len(self.running) > 0:
+            self.launch()
+            time.sleep(poll)
+            if self.check() > 0:
+                poll = self.min_poll
+                self.report()
+            else:
+                poll = min(poll * 2, self.max_poll)
+
 
 # %%
 start = time.time()
-with FolioBaseClient(fep, fte, fun, fpw) as folio:
-    waiting = 1
-    while waiting > 0:
-        res = folio.get_data(
-            "/data-export/job-executions",
-            key="jobExecutions",
-            cql_query=f'status="IN_PROGRESS"',
-        )
-        waiting = len(res)
-        print(f"{waiting}, ", end="")
-        time.sleep(5)
 
+scheduler = ExportScheduler(folio_session(), state, run)
+scheduler.report()
+scheduler.run()
 
+failed = [id for id, (status, _) in scheduler.finished.items() if status == "FAIL"]
+if len(failed) > 0:
+    print(f"{len(failed)} jobs failed")
 print()
 print((time.time() - start) / 60)
 
 # %%
-with FolioBaseClient(fep, fte, fun, fpw) as folio:
-    res = folio.get_data(
-        "/data-export/job-executions",
-        key="jobExecutions",
-        cql_query=f'status="COMPLETED_WITH_ERRORS" sortBy completedDate/sort.descending',
-        limit=10,
-    )
-    import pprint
+res = folio_session().get_data(
+    "/data-export/job-executions",
+    key="jobExecutions",
+    cql_query=f'status="COMPLETED_WITH_ERRORS" sortBy completedDate/sort.descending',
+    limit=10,
+)
+import pprint
 
-    pprint.pprint(res)
+pprint.pprint(res)
 
 # %%
-run = uuid.UUID("d7975a00-0a2b-45f3-b525-f5dd94292f46")
-with FolioBaseClient(fep, fte, fun, fpw) as folio:
-    res = folio.get_data(
-        "/data-export/job-executions",
-        key="jobExecutions",
-        cql_query=f"status=(COMPLETED_WITH_ERRORS)",
-        limit=5,
-    )
-    job_ids = [r["id"] for r in res]
+# after a kernel restart the later cells only need run, the rest of it is in
+#   the state store
+run = state.last_run()
+# run = uuid.UUID("d7975a00-0a2b-45f3-b525-f5dd94292f46")
+print(run, state.summary(run))
 
 # %%
-start = time.time()
-
-jids = job_ids.copy()
-instance_errors = None
-job_errors = None
-with FolioBaseClient(fep, fte, fun, fpw) as folio:
-    output = Path(str(run))
-    shutil.rmtree(output)
-    output.mkdir()
-    print(f"{len(jids)}, ", end="")
-    while len(jids) > 0:
-        print(f"{len(jids)}, ", end="")
-        id = jids.pop()
-        res = folio.get_data(
-            "/data-export/job-executions",
-            key="jobExecutions",
-            cql_query=f'id="{id}"',
-        )
+import hashlib
+import os
+from concurrent.futures import as_completed
+
+download_threads = 8
+# re-hash files that were already downloaded instead of trusting their size
+verify_downloads = False
+
+
+def is_downloaded(path: Path, manifest: dict[str, tuple[int, str]]) -> bool:
+    if not path.exists() or path.name not in manifest:
+        return False
+    size, sha256 = manifest[path.name]
+    if path.stat().st_size != size:
+        return False
+    return not verify_downloads or sha256_file(path) == sha256
+
+
+def download(
+    folio: FolioSession, job_id: str, file_id: str, path: Path
+) -> tuple[str, int, str]:
+    # The link is presigned and expires so it's asked for right before the
+    #   download starts instead of when the download gets queued.
+    # Streams into a .part file that only gets renamed once all of it is
+    #   there, so a file without .part is never half written.
+    link = folio.get_data(f"/data-export/job-executions/{job_id}/download/{file_id}")
+    part = path.with_name(path.name + ".part")
+    h = hashlib.sha256()
+    size = 0
+    with folio.downloads.stream("GET", link["link"]) as res, part.open("wb") as f:
+        res.raise_for_status()
+        for chunk in res.iter_bytes(2**20):
+            f.write(chunk)
+            h.update(chunk)
+            size += len(chunk)
+    os.replace(part, path)
+    return path.name, size, h.hexdigest()
 
-        job = res[0]
-        if job["status"] in ["COMPLETED", "COMPLETED_WITH_ERRORS"]:
-            marc_id = job["exportedFiles"][0]["fileId"]
-            marc_name = job["exportedFiles"][0]["fileName"]
-            res = folio.get_data(f"/data-export/job-executions/{id}/download/{marc_id}")
-            res = httpx.get(res["link"])
-            with (output / marc_name).open("wb") as f:
-                f.write(res.content)
 
-        if job["status"] == "COMPLETED_WITH_ERRORS":
+# %%
+# error logs come back this many a page
+log_page = 5000
+
+log_schema = {
+    "jobExecutionId": pl.Utf8,
+    "errorMessageCode": pl.Utf8,
+    "errorMessageValues": pl.List(pl.Utf8),
+    "affectedId": pl.Utf8,
+    "inventoryRecordLink": pl.Utf8,
+}
+
+
+def error_logs(folio: FolioBaseClient, job_ids: list[str]) -> pl.DataFrame:
+    # Every error log entry of the jobs, status_batch jobs per query and
+    #   paged until totalRecords so nothing gets cut off.
+    cols = {c: [] for c in log_schema}
+    for i in range(0, len(job_ids), status_batch):
+        lookup = job_ids[i : i + status_batch]
+        offset = 0
+        while True:
             res = folio.get_data(
-                f"/data-export/logs",
-                key="errorLogs",
-                limit=10000,
-                cql_query=f'jobExecutionId=="{job["id"]}"',
+                "/data-export/logs",
+                params={"offset": str(offset)},
+                cql_query=f"jobExecutionId==({' or '.join(lookup)})",
+                limit=log_page,
             )
-            for err in res:
-                if "affectedRecord" in err:
-                    if instance_errors is None:
-                        instance_errors = pl.DataFrame([err])
-                    else:
-                        instance_errors.vstack(pl.DataFrame([err]), in_place=True)
-                else:
-                    if job_errors is None:
-                        job_errors = pl.DataFrame([err])
-                    else:
-                        job_errors.vstack(pl.DataFrame([err]), in_place=True)
-
-if instance_errors is not None:
-    instance_errors.glimpse()
-    instance_errors = (
-        instance_errors.rechunk()
-        .with_columns(pl.col("affectedRecord").struct.unnest())
-        .select(
-            pl.col("id").alias("instanceId"),
-            pl.col("errorMessageCode").alias("errorCode"),
-            pl.col("errorMessageValues")
-            .list.join(separator="\n")
-            .alias("errorMessage"),
-            "inventoryRecordLink",
-        )
-    )
-    instance_errors.glimpse()
-
-if job_errors is not None:
-    job_errors.glimpse()
-    job_errors = job_errors.rechunk()
-    opaque_errs = job_errors.filter(
-        pl.col("errorMessageCode").eq("error.someRecordsFailed")
-    ).select(
-        "jobExecutionId", pl.col("errorMessageValues").list.first().alias("errors")
+            for err in res["errorLogs"]:
+                affected = err.get("affectedRecord") or {}
+                cols["jobExecutionId"].append(err["jobExecutionId"])
+                cols["errorMessageCode"].append(err["errorMessageCode"])
+                cols["errorMessageValues"].append(err.get("errorMessageValues"))
+                cols["affectedId"].append(affected.get("id"))
+                cols["inventoryRecordLink"].append(
+                    affected.get("inventoryRecordLink")
+                )
+            offset += len(res["errorLogs"])
+            if len(res["errorLogs"]) == 0 or offset >= res["totalRecords"]:
+                break
+    return pl.DataFrame(cols, schema=log_schema)
+
+
+def split_errors(logs: pl.DataFrame) -> tuple[pl.DataFrame, pl.DataFrame]:
+    # Errors about an instance either have it as the affected record or as
+    #   the first message value, someRecordsFailed only says how many and
+    #   is kept to the side as opaque.
+    affected = pl.col("affectedId").is_not_null()
+    values = pl.col("errorMessageValues")
+    logs = logs.with_columns(
+        opaque=~affected & pl.col("errorMessageCode").eq("error.someRecordsFailed")
     )
-    opaque_errs.glimpse()
-    job_errors = job_errors.filter(
-        pl.col("errorMessageCode").ne("error.someRecordsFailed")
-    ).select(
-        pl.col("errorMessageValues").list.first().alias("instanceId"),
+    errors = logs.filter(~pl.col("opaque")).select(
+        pl.when(affected)
+        .then(pl.col("affectedId"))
+        .otherwise(values.list.first())
+        .alias("instanceId"),
         pl.col("errorMessageCode").alias("errorCode"),
-        pl.col("errorMessageValues")
-        .list.slice(1)
-        .list.join(separator="\n")
+        pl.when(affected)
+        .then(values.list.join(separator="\n"))
+        .otherwise(values.list.slice(1).list.join(separator="\n"))
         .alias("errorMessage"),
-        pl.lit("").alias("inventoryRecordLink"),
+        pl.col("inventoryRecordLink").fill_null(""),
+    )
+    opaque = logs.filter(pl.col("opaque")).select(
+        "jobExecutionId", values.list.first().alias("errors")
     )
-    job_errors.glimpse()
+    return errors, opaque
 
-if instance_errors and job_errors:
-    instance_errors.concat(job_errors)
-else if job_errors:
-    instance_errors = job_errors
 
-if instance_errors:
-    instance_errors.write_csv(output / "errors.csv")
+# %%
+start = time.time()
 
-if opaque_errs:
+output = Path(str(run))
+output.mkdir(exist_ok=True)
+manifest = state.downloads(run)
+downloads = []
+folio = folio_session()
+with ThreadPoolExecutor(download_threads) as pool:
+    # downloads get recorded as they finish so a rerun after a crash still
+    #   knows about them
+    def record(d):
+        if d.exception() is None:
+            state.record_download(run, *d.result())
+
+    jobs = job_statuses(folio, state.job_ids(run))
+    print(jobs.group_by("status").len())
+    for n, (id, status, marc_id, marc_name) in enumerate(jobs.iter_rows()):
+        if n % 100 == 0:
+            print(f"{n}, ", end="")
+        if status in ["COMPLETED", "COMPLETED_WITH_ERRORS"] and marc_id is not None:
+            if not is_downloaded(output / marc_name, manifest):
+                d = pool.submit(download, folio, id, marc_id, output / marc_name)
+                d.add_done_callback(record)
+                downloads.append(d)
+
+    errored = jobs.filter(pl.col("status").eq("COMPLETED_WITH_ERRORS"))
+    errors, opaque_errs = split_errors(error_logs(folio, errored["id"].to_list()))
+
+    failed = sum(d.exception() is not None for d in as_completed(downloads))
+    if failed > 0:
+        print(f"{failed} downloads failed, rerun to pick them up")
+print(dict(folio.metrics))
+
+if len(errors) > 0:
+    errors.write_csv(output / "errors.csv")
+
+if len(opaque_errs) > 0:
     opaque_errs.write_csv(output / "opaque_errors.csv")
 
 print()
@@ -325,7 +901,84 @@ print((time.time() - start) / 60)
 print(run)
 
 # %%
-job_errors.glimpse()
-instance_errors.glimpse()
+errors.glimpse()
+opaque_errs.glimpse()
+
+# %%
+close_session()
+
+# %%
+import mmap
+
+
+def marc_fields(record: bytes, tags: set[bytes]) -> dict[bytes, list[bytes]]:
+    # The directory says where every field is, so only the wanted ones get
+    #   sliced out without the field terminator and nothing gets decoded.
+    base = int(record[12:17])
+    fields = {}
+    for d in range(24, base - 1, 12):
+        tag = record[d : d + 3]
+        if tag in tags:
+            length = int(record[d + 3 : d + 7])
+            start = base + int(record[d + 7 : d + 12])
+            fields.setdefault(tag, []).append(record[start : start + length - 1])
+    return fields
+
+
+def instance_id(record: bytes) -> str | None:
+    # data-export puts the instance id in 999 ff $i, 001 is there for
+    #   records that came from somewhere else
+    fields = marc_fields(record, {b"001", b"999"})
+    for f in fields.get(b"999", []):
+        if f[:2] == b"ff":
+            for sub in f[3:].split(b"\x1f"):
+                if sub[:1] == b"i":
+                    return sub[1:].decode()
+    if b"001" in fields:
+        return fields[b"001"][0].decode()
+    return None
+
+
+def merge_marc(run_dir: Path, merged_f: Path) -> int:
+    # Concatenates the run's .mrc files into merged_f and writes where each
+    #   record ended up to <merged_f>.idx.csv as instance_id,offset,length.
+    # Records are walked with the length from their leaders so the files
+    #   are copied as they are.
+    records = 0
+    offset = 0
+    with (
+        merged_f.open("wb") as out,
+        merged_f.with_suffix(".idx.csv").open("w", newline="") as idx,
+    ):
+        index = csv.writer(idx)
+        index.writerow(["instance_id", "offset", "length"])
+        for mrc in sorted(run_dir.glob("*.mrc")):
+            data = mrc.read_bytes()
+            pos = 0
+            while pos < len(data):
+                length = int(data[pos : pos + 5])
+                record = data[pos : pos + length]
+                if len(record) != length or record[-1:] != b"\x1d":
+                    raise ValueError(f"{mrc} has a broken record at {pos}")
+                index.writerow([instance_id(record), offset + pos, length])
+                pos += length
+                records += 1
+            out.write(data)
+            offset += len(data)
+    return records
+
+
+# %%
+merged = Path(str(run)).with_suffix(".mrc")
+print(merge_marc(Path(str(run)), merged))
+
+# %%
+# pulling a single record back out
+index = pl.read_csv(
+    merged.with_suffix(".idx.csv"), schema_overrides={"instance_id": pl.Utf8}
+)
+with merged.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+    _, offset, length = index.row(0)
+    print(mm[offset : offset + length])
 
 # %%
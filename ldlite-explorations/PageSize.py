@@ -16,146 +16,583 @@
 # %conda env update -n base --file environment.yaml
 
 # %%
+import asyncio
 import os
-from contextlib import contextmanager
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
 
 import httpx
 from dotenv import load_dotenv
 
 
 class RefreshTokenAuth(httpx.Auth):
-    requires_response_body = True
+    # Logs in again refresh_early seconds before the token from
+    #   login-with-expiry runs out, on a background thread so requests never
+    #   wait on it. Only one login runs at a time, threads (or tasks) that get
+    #   a 401 while it does wait for that one instead of starting their own.
+    refresh_early = 60
 
     def __init__(self, base_url, env: str):
-        self.fe = base_url
         self.fu = os.getenv(f"FOLIO_USER_{env}")
         self.fp = os.getenv(f"FOLIO_PASSWORD_{env}")
 
         self.hdr = {"x-okapi-tenant": os.getenv(f"FOLIO_TENANT_{env}")}
+        self._login = httpx.Client(base_url=base_url, headers=self.hdr, timeout=60.0)
+        self._lock = threading.Lock()
+        self._expires = 0.0
         self._do_auth()
 
-    def auth_flow(self, request):
-        request.headers.update(self.hdr)
+        self._closed = threading.Event()
+        self._refresher = threading.Thread(target=self._refresh, daemon=True)
+        self._refresher.start()
+
+    def sync_auth_flow(self, request):
+        if time.time() >= self._expires:
+            self._do_auth(self.hdr)
+        hdr = self.hdr
+        request.headers.update(hdr)
         response = yield request
 
         if response.status_code == 401:
-            self._do_auth()
+            self._do_auth(hdr)
             request.headers.update(self.hdr)
             yield request
 
-    def _do_auth(self):
-        if "x-okapi-token" in self.hdr:
-            del self.hdr["x-okapi-token"]
-        res = httpx.post(
-            self.fe + "/authn/login-with-expiry",
-            headers=self.hdr,
-            json={
-                "username": self.fu,
-                "password": self.fp,
-            },
-        )
-        res.raise_for_status()
-        self.hdr["x-okapi-token"] = res.cookies["folioAccessToken"]
+    async def async_auth_flow(self, request):
+        # logins go through the same lock on a worker thread so the event
+        #   loop keeps going
+        if time.time() >= self._expires:
+            await asyncio.to_thread(self._do_auth, self.hdr)
+        hdr = self.hdr
+        request.headers.update(hdr)
+        response = yield request
+
+        if response.status_code == 401:
+            await asyncio.to_thread(self._do_auth, hdr)
+            request.headers.update(self.hdr)
+            yield request
 
+    def _refresh(self):
+        while not self._closed.wait(
+            max(1, self._expires - self.refresh_early - time.time())
+        ):
+            try:
+                self._do_auth()
+            except httpx.HTTPError as e:
+                # the next request will try again if this keeps failing
+                print(f"token refresh failed: {e}")
 
-@contextmanager
-def get_client():
+    def _do_auth(self, stale=None):
+        with self._lock:
+            # whoever held the lock before already logged in again
+            if stale is not None and stale is not self.hdr:
+                return
+            res = self._login.post(
+                "/authn/login-with-expiry",
+                json={
+                    "username": self.fu,
+                    "password": self.fp,
+                },
+            )
+            res.raise_for_status()
+            self._login.cookies.clear()
+            expires = datetime.fromisoformat(res.json()["accessTokenExpiration"])
+            # swapped whole so a request never sees half an update
+            self.hdr = {**self.hdr, "x-okapi-token": res.cookies["folioAccessToken"]}
+            self._expires = expires.timestamp()
+
+    def close(self):
+        self._closed.set()
+        self._login.close()
+
+
+def _client_args():
     load_dotenv(override=True)
     # env = "DEV"
     env = "PROD"
     base_url = os.getenv(f"FOLIO_ENDPOINT_{env}")
+    return {
+        "base_url": base_url,
+        "auth": RefreshTokenAuth(base_url, env),
+        "timeout": 600.0,
+    }
+
+
+@contextmanager
+def get_client():
+    args = _client_args()
+    try:
+        with httpx.Client(transport=httpx.HTTPTransport(retries=1), **args) as client:
+            yield client
+    finally:
+        args["auth"].close()
+
 
-    with httpx.Client(
-        base_url=base_url,
-        auth=RefreshTokenAuth(base_url, env),
-        transport=httpx.HTTPTransport(retries=1),
-        timeout=600.0,
-    ) as client:
-        yield client
+@asynccontextmanager
+async def get_async_client():
+    args = _client_args()
+    try:
+        async with httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(retries=1), **args
+        ) as client:
+            yield client
+    finally:
+        args["auth"].close()
 
 
 # %%
-import random
-import statistics
-import time
-from uuid import uuid4
+import math
+import tracemalloc
+from array import array
+from time import perf_counter_ns
 
 import orjson
+import polars as pl
+
+# the fields pulled out of every page into columns, the rest gets dropped
+keep = {
+    "id": pl.Utf8,
+    "hrid": pl.Utf8,
+    "title": pl.Utf8,
+    "source": pl.Utf8,
+    "instanceTypeId": pl.Utf8,
+    "discoverySuppress": pl.Boolean,
+}
+
+
+class LatencyHistogram:
+    # HDR style, every power of two of nanoseconds is split into 2**sub_bits
+    #   even buckets so a value is never off by more than 1/2**sub_bits
+    #   (1.6% with 6) and memory stays the same however many get recorded.
+    def __init__(self, sub_bits=6, max_ns=2**42):
+        self.sub_bits = sub_bits
+        self.max_ns = max_ns
+        self.counts = array("Q", [0]) * self._index(max_ns) + array("Q", [0])
+        self.n = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, ns):
+        shift = max(0, ns.bit_length() - self.sub_bits - 1)
+        return (shift << self.sub_bits) + (ns >> shift)
+
+    def _value(self, i):
+        # the middle of the bucket
+        shift = max(0, (i >> self.sub_bits) - 1)
+        return ((i - (shift << self.sub_bits)) << shift) + (1 << shift) // 2
+
+    def record(self, ns):
+        self.counts[self._index(min(ns, self.max_ns))] += 1
+        self.n += 1
+        self.total += ns
+        self.min = ns if self.min is None else min(self.min, ns)
+        self.max = ns if self.max is None else max(self.max, ns)
+
+    def add(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.n += other.n
+        self.total += other.total
+        for v in [other.min, other.max]:
+            if v is not None:
+                self.min = v if self.min is None else min(self.min, v)
+                self.max = v if self.max is None else max(self.max, v)
+
+    def percentile(self, p):
+        if self.n == 0:
+            return None
+        rank = max(1, math.ceil(self.n * p / 100))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(max(self._value(i), self.min), self.max)
+
+    def summary(self, prefix):
+        ms = {f"{prefix}_mean_ms": self.total / max(1, self.n) / 1e6}
+        for p in [50, 90, 99, 99.9]:
+            v = self.percentile(p)
+            ms[f"{prefix}_p{p:g}_ms"] = None if v is None else v / 1e6
+        return ms
+
+
+class PageTimer:
+    # Where the time for a page goes: waiting on FOLIO until the headers
+    #   come back, pulling the body down, orjson, then picking the kept
+    #   fields out into a frame.
+    # orjson parses the body bytes as they are, going through res.text
+    #   first means holding a decoded str copy of the whole page too.
+    # trace_memory also tracks the peak memory of every page, tracemalloc
+    #   slows every allocation down so those timings don't mean much.
+    phases = ["ttfb", "body", "decode", "columns", "total"]
+
+    def __init__(self, key="instances", keep=keep, trace_memory=False):
+        self.key = key
+        self.keep = keep
+        self.trace_memory = trace_memory
+        self.hists = {p: LatencyHistogram() for p in self.phases}
+        self.body_bytes = 0
+        self.peak_bytes = []
+
+    def get(self, client, endpoint, params):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+
+        start = perf_counter_ns()
+        with client.stream("GET", endpoint, params=params) as res:
+            headers = perf_counter_ns()
+            res.raise_for_status()
+            body = res.read()
+        downloaded = perf_counter_ns()
+        self.body_bytes += len(body)
+        records = orjson.loads(body)[self.key]
+        # res holds on to the body as well
+        del body, res
+        decoded = perf_counter_ns()
+        page = pl.DataFrame(
+            {f: [r.get(f) for r in records] for f in self.keep}, schema=self.keep
+        )
+        del records
+        built = perf_counter_ns()
+
+        if self.trace_memory:
+            self.peak_bytes.append(tracemalloc.get_traced_memory()[1] - before)
+        self.hists["ttfb"].record(headers - start)
+        self.hists["body"].record(downloaded - headers)
+        self.hists["decode"].record(decoded - downloaded)
+        self.hists["columns"].record(built - decoded)
+        self.hists["total"].record(built - start)
+        return page
+
+    def add(self, other):
+        for p in self.phases:
+            self.hists[p].add(other.hists[p])
+        self.body_bytes += other.body_bytes
+        self.peak_bytes += other.peak_bytes
+
+    def summary(self):
+        s = {k: v for p in self.phases for k, v in self.hists[p].summary(p).items()}
+        s["body_mb_mean"] = self.body_bytes / max(1, self.hists["total"].n) / 2**20
+        if len(self.peak_bytes) > 0:
+            s["peak_mb_mean"] = sum(self.peak_bytes) / len(self.peak_bytes) / 2**20
+            s["peak_mb_max"] = max(self.peak_bytes) / 2**20
+        return s
+
+
+# %%
+import random
+from uuid import uuid4
 
 
 def gen_id():
     return str(random.randint(0, 4)) + str(uuid4())[1:]
 
 
-def run_test(target, limit, endpoint):
+def run_test(target, limit, endpoint, trace_memory=False):
+    if trace_memory:
+        tracemalloc.start()
     with get_client() as client:
         total = 0
-        call_times = []
-        start = time.time()
+        timer = PageTimer(trace_memory=trace_memory)
+        start = perf_counter_ns()
         while total < target:
             if total % 100000 == 0:
                 print(".", end="")
 
-            call_start = time.time()
-            res = client.get(
+            timer.get(
+                client,
                 endpoint,
                 params={
                     "query": f'id>"{gen_id()}" sortBy id asc',
                     "limit": limit,
                 },
             )
-            res.raise_for_status()
-            orjson.loads(res.text)
-            call_times.append(time.time() - call_start)
 
             total += limit
 
-        return (
-            time.time() - start,
-            min(call_times),
-            statistics.mean(call_times),
-            statistics.median(call_times),
-            max(call_times),
-        )
+        took = (perf_counter_ns() - start) / 1e9
+    if trace_memory:
+        tracemalloc.stop()
+    return took, timer
 
 
 # %%
-import polars as pl
-
-rs = {
-    "endpoint": pl.Utf8,
-    "limit": pl.Int32,
-    "total": pl.Float32,
-    "per_100k_avg": pl.Float32,
-    "per_100k_med": pl.Float32,
-}
 endpoint = "/inventory/instances"
-results = pl.DataFrame([], schema=rs)
+rows = []
 for l in range(0, 50001, 10000):
     if l == 0:
         l = 1000
+    # memory gets its own few pages, tracing it would throw the timings off
+    _, traced = run_test(5 * l, l, endpoint, trace_memory=True)
+    memory = {k: v for k, v in traced.summary().items() if k.startswith("peak_")}
+    print(l, memory)
     for i in range(0, 5):
         print(l, " ", end="")
-        res = run_test(500000, l, endpoint)
-        results.vstack(
-            pl.DataFrame(
-                [
-                    [
-                        endpoint,
-                        l,
-                        res[0] / 60,
-                        (100000 / l) * (res[2] / 60),
-                        (100000 / l) * (res[3] / 60),
-                    ]
-                ],
-                orient="row",
-                schema=rs,
-            ),
-            in_place=True,
+        took, timer = run_test(500000, l, endpoint)
+        med = timer.hists["total"].percentile(50) / 1e9
+        rows.append(
+            {
+                "endpoint": endpoint,
+                "limit": l,
+                "total": took / 60,
+                "per_100k_med": (100000 / l) * (med / 60),
+                **timer.summary(),
+                **memory,
+            }
         )
-        print(" ", res)
+        print(" ", took, med)
 
+results = pl.DataFrame(rows)
 results.glimpse()
 results.write_csv("results.csv")
 
 # %%
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def load_test(target, limit, endpoint, concurrency):
+    # concurrency workers share one client, and with it one RefreshTokenAuth,
+    #   pulling random pages until target records have been asked for
+    with get_client() as client:
+        claimed = 0
+        claiming = threading.Lock()
+
+        def worker():
+            nonlocal claimed
+            timer = PageTimer()
+            while True:
+                with claiming:
+                    if claimed >= target:
+                        return timer
+                    claimed += limit
+
+                timer.get(
+                    client,
+                    endpoint,
+                    params={
+                        "query": f'id>"{gen_id()}" sortBy id asc',
+                        "limit": limit,
+                    },
+                )
+
+        start = perf_counter_ns()
+        timer = PageTimer()
+        with ThreadPoolExecutor(concurrency) as pool:
+            for w in [pool.submit(worker) for _ in range(concurrency)]:
+                timer.add(w.result())
+        took = (perf_counter_ns() - start) / 1e9
+
+        return took, timer.hists["total"].n * limit / took, timer
+
+
+# %%
+# flip this on to run the concurrency sweep, it pulls ~25M records from PROD
+load_test_run = False
+
+if load_test_run:
+    rows = []
+    for c in [1, 2, 4, 8, 16]:
+        for l in [1000, 5000, 10000, 20000]:
+            print(c, l, " ", end="")
+            took, records_per_s, timer = load_test(200000 * c, l, endpoint, c)
+            rows.append(
+                {
+                    "endpoint": endpoint,
+                    "concurrency": c,
+                    "limit": l,
+                    "total": took / 60,
+                    "records_per_s": records_per_s,
+                    **timer.summary(),
+                }
+            )
+            print(" ", took, records_per_s)
+
+    load_results = pl.DataFrame(rows)
+
+    # throughput against one worker at the same limit, where this stops going
+    #   up is as parallel as it's worth extracting
+    load_results = load_results.sort("limit", "concurrency").with_columns(
+        speedup=pl.col("records_per_s") / pl.col("records_per_s").first().over("limit")
+    )
+    load_results.glimpse()
+    load_results.write_csv("load_results.csv")
+
+# %%
+import uuid
+from pathlib import Path
+
+
+class Harvester:
+    # Pulls a whole collection by splitting the id keyspace into ranges and
+    #   keyset paging each one on its own thread, with every range going to
+    #   its own <n>.ndjson in out_dir.
+    # How far each range got is kept in harvest.json after every page so a
+    #   rerun with the same out_dir picks up from there. Once the untouched
+    #   ranges run out a free worker takes the back half of whichever range
+    #   looks to have the most left, so dense parts of the keyspace don't
+    #   leave one thread going on its own at the end.
+    def __init__(self, out_dir, endpoint, key, ranges=16, limit=5000):
+        self.out_dir = Path(out_dir)
+        self.endpoint = endpoint
+        self.key = key
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.state_f = self.out_dir / "harvest.json"
+
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        if self.state_f.exists():
+            self.ranges = orjson.loads(self.state_f.read_bytes())
+            for r in self.ranges:
+                # anything written after the last save gets paged again
+                with self._range_f(r).open("ab") as f:
+                    f.truncate(r["offset"])
+        else:
+            bounds = [uuid.UUID(int=i * 2**128 // ranges) for i in range(ranges)]
+            bounds.append(uuid.UUID(int=2**128 - 1))
+            self.ranges = [
+                {
+                    "n": n,
+                    "lo": str(lo),
+                    "hi": str(hi),
+                    "last": str(lo),
+                    "offset": 0,
+                    "records": 0,
+                    "done": False,
+                }
+                for n, (lo, hi) in enumerate(zip(bounds, bounds[1:]))
+            ]
+        self.taken = set()
+
+    def _range_f(self, r):
+        return self.out_dir / f"{r['n']}.ndjson"
+
+    def _save(self):
+        tmp = self.state_f.with_suffix(".tmp")
+        tmp.write_bytes(orjson.dumps(self.ranges))
+        os.replace(tmp, self.state_f)
+
+    def _left(self, r, density):
+        # records the range probably still has, from how dense it's been so far
+        done = uuid.UUID(r["last"]).int - uuid.UUID(r["lo"]).int
+        left = uuid.UUID(r["hi"]).int - uuid.UUID(r["last"]).int
+        if done > 0 and r["records"] > 0:
+            density = r["records"] / done
+        return left * density
+
+    def _claim(self):
+        with self.lock:
+            for r in self.ranges:
+                if not r["done"] and r["n"] not in self.taken:
+                    self.taken.add(r["n"])
+                    return r
+
+            busy = [r for r in self.ranges if not r["done"]]
+            if len(busy) == 0:
+                return None
+            covered = sum(
+                uuid.UUID(r["last"]).int - uuid.UUID(r["lo"]).int for r in self.ranges
+            )
+            density = sum(r["records"] for r in self.ranges) / max(1, covered)
+            densest = max(busy, key=lambda r: self._left(r, density))
+            if self._left(densest, density) < 2 * self.limit:
+                return None
+
+            # the busy worker sees the lower hi before its next page
+            mid = uuid.UUID(
+                int=(uuid.UUID(densest["last"]).int + uuid.UUID(densest["hi"]).int)
+                // 2
+            )
+            r = {
+                "n": len(self.ranges),
+                "lo": str(mid),
+                "hi": densest["hi"],
+                "last": str(mid),
+                "offset": 0,
+                "records": 0,
+                "done": False,
+            }
+            densest["hi"] = str(mid)
+            self.ranges.append(r)
+            self.taken.add(r["n"])
+            self._save()
+            return r
+
+    def _harvest_range(self, client, r):
+        with self._range_f(r).open("ab") as f:
+            while not r["done"] and not self.failed.is_set():
+                res = client.get(
+                    self.endpoint,
+                    params={
+                        "query": f'id>"{r["last"]}" and id<="{r["hi"]}" sortBy id asc',
+                        "limit": self.limit,
+                    },
+                )
+                res.raise_for_status()
+                page = orjson.loads(res.content)[self.key]
+
+                with self.lock:
+                    # hi can drop while the page is out, the rest of it
+                    #   belongs to the range that was split off
+                    keep = [p for p in page if p["id"] <= r["hi"]]
+                    f.write(b"".join(orjson.dumps(p) + b"\n" for p in keep))
+                    f.flush()
+                    r["offset"] = f.tell()
+                    r["records"] += len(keep)
+                    if len(keep) > 0:
+                        r["last"] = keep[-1]["id"]
+                    r["done"] = len(keep) < len(page) or len(page) < self.limit
+                    self._save()
+                    self.harvested += len(keep)
+                    self.pages += 1
+                    if self.pages % 20 == 0:
+                        print(".", end="")
+
+    def run(self, workers=8):
+        self.taken = set()
+        self.harvested = 0
+        self.pages = 0
+        self.failed = threading.Event()
+        start = time.time()
+        with get_client() as client, ThreadPoolExecutor(workers) as pool:
+
+            def worker():
+                while not self.failed.is_set() and not all(
+                    r["done"] for r in self.ranges
+                ):
+                    r = self._claim()
+                    if r is None:
+                        # nothing worth splitting yet, but there might be soon
+                        time.sleep(1)
+                        continue
+                    try:
+                        self._harvest_range(client, r)
+                    except BaseException:
+                        # the others stop too, a rerun carries on from the state
+                        self.failed.set()
+                        raise
+
+            for w in [pool.submit(worker) for _ in range(workers)]:
+                w.result()
+
+        took = time.time() - start
+        total = sum(r["records"] for r in self.ranges)
+        print()
+        print(f"{self.harvested} records in {took / 60:.1f} minutes", end="")
+        print(f" ({self.harvested / took:.0f}/s), {total} in {len(self.ranges)} ranges")
+        return total
+
+
+# %%
+# flip this on to pull every instance down, it takes a while
+harvest = False
+
+if harvest:
+    harvester = Harvester("./instances", "/inventory/instances", "instances")
+    harvester.run(workers=8)
+
+# %%